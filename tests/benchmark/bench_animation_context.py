@@ -0,0 +1,46 @@
+"""
+Microbenchmark for the cost of setting a property, inside and outside an animation block, when called
+at different stack depths.
+
+Time per setter should not depend on the depth of the stack.
+
+    python -m tests.benchmark.bench_animation_context
+"""
+import timeit
+
+from ui4.animation import duration
+from ui4.core import Core
+from ui4.view import View
+
+
+def at_depth(depth, func):
+    if depth:
+        return at_depth(depth - 1, func)
+    return func()
+
+
+def set_properties(views):
+    for view in views:
+        view.left = 10
+
+
+def set_properties_animated(views):
+    with duration(0.5):
+        for view in views:
+            view.left = 10
+
+
+def main():
+    Core._clean_state()
+    views = [View() for _ in range(1000)]
+    print(f'{"depth":>6} {"plain us/set":>14} {"animated us/set":>16}')
+    for depth in (0, 50, 200, 800):
+        timings = []
+        for func in (set_properties, set_properties_animated):
+            count, total = timeit.Timer(lambda: at_depth(depth, lambda: func(views))).autorange()
+            timings.append(total / count / len(views) * 1e6)
+        print(f'{depth:>6} {timings[0]:>14.2f} {timings[1]:>16.2f}')
+
+
+if __name__ == '__main__':
+    main()
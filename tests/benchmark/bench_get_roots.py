@@ -0,0 +1,42 @@
+"""
+Microbenchmark for finding the roots of the dirty subtrees, e.g. after a bulk table update.
+
+Time per dirty view should stay flat as the number of dirty views and the depth of the tree grow.
+
+    python -m tests.benchmark.bench_get_roots
+"""
+import timeit
+
+from ui4.core import Core
+from ui4.core import Identity
+
+
+def table(depth, rows, columns):
+    Core._clean_state()
+    parent = Core()
+    for _ in range(depth):
+        parent = Core(parent=parent)
+    cells = []
+    for _ in range(rows):
+        row = Core(parent=parent)
+        cells.extend(Core(parent=row) for _ in range(columns))
+    return cells
+
+
+def main():
+    Identity.max_views_per_session = None
+    print(f'{"depth":>6} {"dirty":>8} {"ms/call":>10} {"us/dirty":>10}')
+    for depth in (10, 100):
+        for rows in (100, 400, 1600):
+            cells = table(depth, rows, 5)
+            Core._clear_dirties()
+            for cell in cells:
+                cell._mark_dirty()
+
+            count, total = timeit.Timer(Core._get_roots).autorange()
+            per_call = total / count
+            print(f'{depth:>6} {len(cells):>8} {per_call * 1000:>10.2f} {per_call / len(cells) * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -122,6 +122,10 @@ def set_up_test_page(tmp_path):
         index_html = template.safe_substitute(
             app_name='Test page',
             gap=gap,
+            ui4_js='ui4.js',
+            ui4parser_js='ui4parser.js',
+            styles='',
+            push_updates='false',
             content=contents,
         )
         index_file = tmp_path / 'index.html'
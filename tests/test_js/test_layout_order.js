@@ -0,0 +1,104 @@
+/*jshint esversion: 9 */
+
+const UI4 = require("../../ui4/static/ui4.js");
+assert = require('assert');
+expect = require('chai').expect;
+
+describe("orderTargets", () => {
+    it('orders targets after their sources and groups cycles', async () => {
+        const ui4 = new UI4();
+        ui4.sourceDependencies = {
+            a: {b: true},
+            b: {c: true, d: true},
+            c: {b: true},
+            d: {e: true},
+            e: {e: true},  // Self-references are not cycles
+        };
+        expect(ui4.orderTargets(new Set(["e", "d", "c", "b", "a"]))).to.deep.equal(
+            [["a"], ["c", "b"], ["d"], ["e"]]
+        );
+    });
+    it('handles long dependency chains', async () => {
+        const ui4 = new UI4();
+        const ids = [];
+        for (let i = 0; i < 20000; i++) {
+            ids.push(`id${i}`);
+            ui4.sourceDependencies[`id${i}`] = {[`id${i + 1}`]: true};
+        }
+        const components = ui4.orderTargets(new Set([...ids].reverse()));
+        expect(components.map(component => component[0])).to.deep.equal(ids);
+    });
+});
+
+describe("solve", () => {
+    const dependsOn = (...sourceIDs) => [{value: {dependencyIDs: sourceIDs}}];
+
+    it('checks targets once and cycles until settled', async () => {
+        const ui4 = new UI4();
+        ui4.sourceDependencies = {a: {b: true}, b: {c: true, d: true}, c: {b: true}};
+        ui4.allDependencies = {b: dependsOn("a", "c"), c: dependsOn("b"), d: dependsOn("b")};
+        const checked = [];
+        ui4.measureTarget = (targetId) => [];
+        ui4.mutateTarget = (targetId, measured) => checked.push(targetId);
+        ui4.checkDependenciesFor = (targetId) => {
+            checked.push(targetId);
+            return targetId === "b" && checked.length < 4;
+        };
+        ui4.solve(new Set(["d", "c", "b", "a"]));
+        expect(checked).to.deep.equal(["c", "b", "c", "b", "d"]);
+    });
+    it('measures all independent targets before setting their styles', async () => {
+        const ui4 = new UI4();
+        ui4.sourceDependencies = {a: {b: true, c: true}, b: {d: true}};
+        ui4.allDependencies = {b: dependsOn("a"), c: dependsOn("a"), d: dependsOn("b")};
+        const phases = [];
+        ui4.measureTarget = (targetId) => phases.push(`measure ${targetId}`) && [];
+        ui4.mutateTarget = (targetId, measured) => phases.push(`mutate ${targetId}`);
+        ui4.solve(new Set(["a", "b", "c", "d"]));
+        expect(phases).to.deep.equal(["measure c", "measure b", "mutate c", "mutate b", "measure d", "mutate d"]);
+    });
+});
+
+describe("isJitter", () => {
+    it('detects values alternating between two values', async () => {
+        const ui4 = new UI4();
+        const results = [1, 1.5, 1, 1.5, 1, 1.5, 3, 1].map(value => ui4.isJitter("id1", "left", value));
+        expect(results).to.deep.equal([false, false, false, false, true, true, false, false]);
+    });
+    it('does not mistake a toggled value for jitter', async () => {
+        const ui4 = new UI4();
+        const results = [100, 200, 100, 200, 100, 200].map(value => ui4.isJitter("id1", "width", value));
+        expect(results).to.deep.equal([false, false, false, false, false, false]);
+    });
+    it('does not mistake a steady change for jitter', async () => {
+        const ui4 = new UI4();
+        const results = [1, 2, 3, 4, 5, 6].map(value => ui4.isJitter("id1", "left", value));
+        expect(results).to.deep.equal([false, false, false, false, false, false]);
+    });
+    it('keeps a fixed number of values per style', async () => {
+        const ui4 = new UI4();
+        for (let value = 0; value < 100; value++) {
+            ui4.isJitter("id1", "left", value);
+        }
+        expect(ui4.previousValues.get("id1").get("left").values.length).to.equal(UI4.jitterHistorySize);
+    });
+});
+
+describe("measureTarget", () => {
+    it('centers with the styles measured before it for the same target', async () => {
+        const ui4 = new UI4();
+        const context = {
+            dependencies: [{targetAttribute: "left"}, {targetAttribute: "centerx"}],
+            getStyle: {left: "0px"},  // Not yet moved
+            style: {},
+            parentElem: {clientWidth: 400},
+            targetElem: {offsetWidth: 0},
+        };
+        ui4.allDependencies = {target: []};
+        ui4.checkResults = () => [{left: {context, sourceValue: 100}, centerx: {context, sourceValue: 150}}];
+
+        expect(ui4.measureTarget("target").map(measured => measured.updates)).to.deep.equal(
+            [{left: "100px"}, {width: "100px"}]
+        );
+    });
+});
@@ -0,0 +1,220 @@
+/*jshint esversion: 9 */
+
+const UI4 = require("../../ui4/static/ui4.js");
+assert = require('assert');
+expect = require('chai').expect;
+
+beforeEach(function () {
+  this.jsdomClean = require('jsdom-global')();
+  this.observed = new Set();
+  const observed = this.observed;
+  global.ResizeObserver = class {
+      observe(elem) { observed.add(elem.id); }
+      unobserve(elem) { observed.delete(elem.id); }
+  };
+  global.requestAnimationFrame = (callback) => 1;
+});
+
+after(function () {
+  this.jsdomClean();
+});
+
+function addDiv(id, ui4Attr) {
+    const div = document.createElement("div");
+    div.id = id;
+    if (ui4Attr) {
+        div.setAttribute("ui4", ui4Attr);
+    }
+    document.body.appendChild(div);
+    return div;
+}
+
+describe("ResizeObserver", () => {
+    it('observes only the elements others depend on', async function () {
+        const ui4 = new UI4();
+        const source = addDiv("source");
+        const other = addDiv("other");
+        const target = addDiv("target", "left=source.left");
+        [source, other, target].forEach(node => ui4.setDependencies(node));
+
+        expect([...this.observed]).to.deep.equal(["source"]);
+
+        target.setAttribute("ui4", "left=other.left");
+        ui4.setDependencies(target);
+
+        expect([...this.observed]).to.deep.equal(["other"]);
+        expect(ui4.sourceDependencies).to.deep.equal({other: {target: true}});
+    });
+    it('stops observing removed elements', async function () {
+        const ui4 = new UI4();
+        const source = addDiv("source");
+        const target = addDiv("target", "left=source.left");
+        [source, target].forEach(node => ui4.setDependencies(node));
+
+        source.remove();
+        ui4.forgetElements(source);
+
+        expect([...this.observed]).to.deep.equal([]);
+    });
+});
+
+describe("forgetElements", () => {
+    it('drops the value histories of removed elements', async function () {
+        const ui4 = new UI4();
+        const target = addDiv("target", "left=10");
+        ui4.isJitter("target", "left", 1);
+
+        target.remove();
+        ui4.forgetElements(target);
+
+        expect(ui4.previousValues.size).to.equal(0);
+    });
+});
+
+describe("forgetTarget", () => {
+    it('keeps the maps flat when views come and go', async function () {
+        const ui4 = new UI4();
+        const container = addDiv("container");
+        ui4.setDependencies(container);
+        for (let i = 0; i < 1000; i++) {
+            const card = document.createElement("div");
+            card.id = `card${i}`;
+            card.setAttribute("ui4", "left=container.left;layout=grid;gap=4");
+            const label = document.createElement("div");
+            label.id = `label${i}`;
+            label.setAttribute("ui4", `top=card${i}.top;width=container.width`);
+            card.appendChild(label);
+            container.appendChild(card);
+            ui4.setDependencies(card);
+
+            card.remove();
+            ui4.forgetElements(card);
+        }
+
+        expect(ui4.allDependencies).to.deep.equal({});
+        expect(ui4.sourceDependencies).to.deep.equal({});
+        expect(ui4.layouts).to.deep.equal({});
+        expect(ui4.gaps).to.deep.equal({});
+        expect([...this.observed]).to.deep.equal([]);
+    });
+    it('keeps the constraints of replaced elements', async function () {
+        const ui4 = new UI4();
+        const source = addDiv("source");
+        const target = addDiv("target", "left=source.left");
+        [source, target].forEach(node => ui4.setDependencies(node));
+
+        const replacement = document.createElement("div");
+        replacement.id = "target";
+        replacement.setAttribute("ui4", "left=source.left");
+        target.replaceWith(replacement);
+        ui4.forgetElements(target);
+
+        expect(Object.keys(ui4.allDependencies)).to.deep.equal(["target"]);
+        expect(ui4.sourceDependencies).to.deep.equal({source: {target: true}});
+    });
+});
+
+describe("setDependencies", () => {
+    it('parses only changed constraints', async function () {
+        const ui4 = new UI4();
+        const source = addDiv("source");
+        const target = addDiv("target", "left=source.left");
+        ui4.setDependencies(source);
+        let parsed = 0;
+        const parse = ui4.parseAndOrderDependencies.bind(ui4);
+        ui4.parseAndOrderDependencies = (...args) => { parsed++; return parse(...args); };
+
+        ui4.setDependencies(target);
+        ui4.setDependencies(target);
+        expect(parsed).to.equal(1);
+
+        target.setAttribute("ui4", "left=source.right");
+        ui4.setDependencies(target);
+        expect(parsed).to.equal(2);
+    });
+    it('lays out only the swapped elements and their dependants', async function () {
+        const ui4 = new UI4();
+        const nodes = [
+            addDiv("card1", "left=10"),
+            addDiv("card2", "left=10"),
+            addDiv("below", "top=card2.bottom"),
+        ];
+        nodes.forEach(node => ui4.setDependencies(node));
+        ui4.pendingLayouts.clear();
+
+        const swapped = document.createElement("div");
+        swapped.id = "card2";
+        swapped.setAttribute("ui4", "left=20");
+        nodes[1].replaceWith(swapped);
+        ui4.classChangeHandler([{type: "childList", addedNodes: [swapped], removedNodes: [nodes[1]]}]);
+
+        expect([...ui4.pendingLayouts]).to.deep.equal(["card2"]);
+        expect([...ui4.withDependants(ui4.pendingLayouts)]).to.deep.equal(["card2", "below"]);
+    });
+});
+
+describe("applyPatches", () => {
+    it('lays out constrained elements again after a style patch', async function () {
+        const ui4 = new UI4();
+        const target = addDiv("target", "left=10");
+        ui4.setDependencies(target);
+        ui4.pendingLayouts.clear();
+
+        const patch = document.createElement("div");
+        patch.id = "ui4patch";
+        patch.setAttribute("ui4patch", JSON.stringify([{id: "target", attributes: {style: "color:red"}}]));
+        ui4.applyPatches(patch);
+
+        expect(target.style.color).to.equal("red");
+        expect(target.style.position).to.equal("absolute");
+        expect([...ui4.pendingLayouts]).to.deep.equal(["target"]);
+    });
+});
+
+describe("scheduleSteps", () => {
+    it('applies the pending steps before a newer response', async function () {
+        const ui4 = new UI4();
+        const applied = [];
+        ui4.applyFragment = (html) => applied.push(html);
+
+        const steps = document.createElement("div");
+        steps.id = "ui4steps";
+        for (const html of ["step 1", "step 2"]) {
+            const step = document.createElement("template");
+            step.setAttribute("data-delay", "10");
+            step.innerHTML = html;
+            steps.appendChild(step);
+        }
+        ui4.scheduleSteps(steps);
+        ui4.finishSteps();
+        applied.push("response");
+        await new Promise(resolve => setTimeout(resolve, 0));
+
+        expect(applied).to.deep.equal(["step 1", "step 2", "response"]);
+        expect(ui4.pendingSteps).to.deep.equal([]);
+    });
+});
+
+describe("batchEvent", () => {
+    it('sends other events after the batch in flight', async function () {
+        const ui4 = new UI4();
+        const button = addDiv("button");
+        const sent = [];
+        global.fetch = (url, options) => {
+            sent.push(JSON.parse(options.body).events.map(pending => pending.type));
+            return Promise.resolve({ok: true, text: () => ""});
+        };
+        let prevented = false;
+
+        ui4.pendingEvents.set("field", {id: "field", type: "input", value: "a"});
+        ui4.sendBatch();
+        ui4.batchEvent({
+            detail: {path: "/event", elt: button, triggeringEvent: {type: "click"}, parameters: {}},
+            preventDefault: () => { prevented = true; },
+        });
+        await new Promise(resolve => setTimeout(resolve, 0));
+
+        expect(prevented).to.equal(true);
+        expect(sent).to.deep.equal([["input"], ["click"]]);
+    });
+});
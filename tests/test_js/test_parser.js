@@ -74,3 +74,37 @@ describe("Parser.parse", () => {
         );
     });
 });
+
+describe("UI4.expandCompiledTree", () => {
+    it('expands a compiled tree to the parsed tree', async () => {
+        expect(new UI4().expandCompiledTree(["*", ["+", "id1.left", "gap"], {min: ["id2.width", 3]}])).to.deep.equal(
+            parser.parse("(id1.left+gap)*min(id2.width,3)")
+        );
+    });
+    it('expands a number', async () => {
+        expect(new UI4().expandCompiledTree(0.5)).to.deep.equal(parser.parse("(1+3)/8"));
+    });
+});
+
+describe("UI4.parseSourceSpec", () => {
+    it('parses like the parser', async () => {
+        const spec = "(id1.left+gap)*min(id2.width,id1.width)";
+        expect(new UI4().parseSourceSpec(spec)).to.deep.equal(parser.parse(spec));
+    });
+    it('shares one template between specs that differ only by ids', async () => {
+        const ui4 = new UI4();
+        const tree = ui4.parseSourceSpec("id3.right+gap");
+        tree.left.function = () => 0;  // Finalizing must not modify the cached template
+
+        expect(ui4.parseSourceSpec("id8.right+gap")).to.deep.equal(parser.parse("id8.right+gap"));
+        expect([...ui4.parseCache.keys()]).to.deep.equal(["_0.right+gap"]);
+    });
+    it('drops the least recently used templates', async () => {
+        const ui4 = new UI4();
+        for (let i = 0; i <= UI4.parseCacheSize; i++) {
+            ui4.parseSourceSpec(`id1.width+${i}`);
+        }
+        expect(ui4.parseCache.size).to.equal(UI4.parseCacheSize);
+        expect(ui4.parseCache.has("_0.width+0")).to.be.false;
+    });
+});
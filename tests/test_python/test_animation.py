@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from ui4.animation import *
 from ui4.animation import _animation_context
 
@@ -60,3 +62,20 @@ def test_dedicated_contextmanagers():
 
     with iterations(3):
         assert _animation_context().iterations == 3
+
+
+def test_animation_context_per_thread():
+    with duration(3):
+        with ThreadPoolExecutor(1) as executor:
+            assert executor.submit(_animation_context).result() is None
+        assert _animation_context().duration == 3
+
+
+def test_animation_context_reset_on_exception():
+    try:
+        with duration(3):
+            raise ValueError()
+    except ValueError:
+        pass
+
+    assert _animation_context() is None
@@ -0,0 +1,176 @@
+import gzip
+import json
+import re
+
+import pytest
+
+from ui4.app import App
+from ui4.app import FlaskRunner
+from ui4.app import wsgi
+from ui4.core import Identity
+from ui4.textfield import TextField
+from ui4.view import View
+
+
+@pytest.fixture
+def client():
+    def get_client(setup_func, **kwargs):
+        app = App(runner_class=FlaskRunner, **kwargs)
+        app.runner._setup_func = setup_func
+        return app.runner.flask.test_client()
+
+    return get_client
+
+
+def test_index_is_streamed(client):
+    def setup(root):
+        for i in range(100):
+            View(parent=root, text=f'view {i}')
+
+    response = client(setup).get('/')
+
+    assert response.is_streamed
+    page = response.get_data(as_text=True)
+    assert page.index('ui4.js') < page.index('view 0') < page.index('view 99') < page.index('</html>')
+
+
+def test_static_assets_are_compressed_and_cached(client):
+    test_client = client(lambda root: None)
+    page = test_client.get('/').get_data(as_text=True)
+    js_url = re.search(r'src="(ui4\.js\?v=\w+)"', page).group(1)
+
+    response = test_client.get(f'/{js_url}', headers={'Accept-Encoding': 'gzip'})
+
+    assert response.status_code == 200
+    assert response.content_encoding == 'gzip'
+    assert 'immutable' in response.headers['Cache-Control']
+    assert gzip.decompress(response.data).startswith(b'/*jshint')
+
+    response = test_client.get(f'/{js_url}', headers={
+        'Accept-Encoding': 'gzip',
+        'If-None-Match': response.headers['ETag'],
+    })
+
+    assert response.status_code == 304
+
+    response = test_client.get('/ui4.js', headers={'Accept-Encoding': 'identity'})
+
+    assert response.content_encoding is None
+    assert 'no-cache' in response.headers['Cache-Control']
+
+
+def test_sessions_are_kept_apart(client):
+    default_user_id = Identity.get_user_id()
+
+    for _ in range(2):
+        client(lambda root: View(parent=root)).get('/').get_data()
+
+    assert len(Identity._views) == 2
+    assert default_user_id not in Identity._views
+    assert Identity.get_user_id() == default_user_id
+
+
+def test_wsgi_entry_point():
+    flask_app = wsgi(lambda root: View(parent=root, text='hello'), secret_key='secret')
+
+    assert flask_app.secret_key == 'secret'
+    assert not flask_app.debug
+    assert 'hello' in flask_app.test_client().get('/').get_data(as_text=True)
+
+
+def test_updates_are_pushed(client):
+    views = {}
+
+    def setup(root):
+        views['label'] = View(parent=root, text='before')
+
+    test_client = client(setup, push_updates=True)
+    test_client.get('/').get_data()
+    response = test_client.get('/updates')
+    chunks = response.iter_encoded()
+
+    assert response.mimetype == 'text/event-stream'
+    assert next(chunks) == b': keepalive\n\n'
+
+    views['label'].text = 'after'
+    message = next(chunks).decode()
+
+    assert message.startswith('data: ')
+    assert 'after' in message
+
+    response.close()
+
+    assert not View._push_listeners
+
+
+def test_updates_are_not_pushed_by_default(client):
+    test_client = client(lambda root: None)
+    page = test_client.get('/').get_data(as_text=True)
+
+    assert 'ui4.pushUpdates = false' in page
+    assert test_client.get('/updates').status_code == 404
+
+
+def test_batched_events(client):
+    views = {}
+    values = []
+
+    def setup(root):
+        field = views['field'] = TextField(parent=root)
+        views['button'] = View(parent=root)
+
+        @field
+        def on_input(data):
+            values.append(data.value)
+
+    test_client = client(setup)
+    test_client.get('/').get_data()
+    field_id = views['field'].id
+
+    response = test_client.post('/events', json={'events': [
+        {'id': field_id, 'type': 'input', 'value': 'a'},
+        {'id': 'id_unknown', 'type': 'input', 'value': 'x'},
+        {'id': field_id, 'type': 'input', 'value': 'ab'},
+    ]})
+
+    assert response.status_code == 200
+    assert values == ['a', 'ab']
+
+    response = test_client.post('/event', data={
+        'ui4batch': json.dumps([{'id': field_id, 'type': 'input', 'value': 'abc'}]),
+    }, headers={
+        'Hx-Trigger': views['button'].id,
+        'Triggering-Event': json.dumps({'type': 'click'}),
+    })
+
+    assert response.status_code == 200
+    assert values == ['a', 'ab', 'abc']
+
+
+def test_events_without_session_are_rejected(client):
+    response = client(lambda root: None).post('/event', headers={'Hx-Trigger': 'id1'})
+
+    assert response.status_code == 410
+    assert Identity._views == {}
+
+
+def test_handler_exceptions_are_not_masked():
+    views = {}
+
+    def setup(root):
+        button = views['button'] = View(parent=root)
+
+        @button
+        def on_click(data):
+            raise ValueError('from handler')
+
+    flask_app = wsgi(setup)
+    flask_app.testing = True
+    test_client = flask_app.test_client()
+    test_client.get('/').get_data()
+
+    with pytest.raises(ValueError, match='from handler'):
+        test_client.post('/event', headers={
+            'Hx-Trigger': views['button'].id,
+            'Triggering-Event': json.dumps({'type': 'click'}),
+        })
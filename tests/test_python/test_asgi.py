@@ -0,0 +1,279 @@
+import asyncio
+import contextlib
+import json
+import urllib.parse
+
+import pytest
+
+from ui4.asgi import asgi_app
+from ui4.core import Events
+from ui4.core import Identity
+from ui4.view import View
+
+
+# Like a server, one event loop for all requests. asyncio.run would close the async generators between requests.
+loop = asyncio.new_event_loop()
+
+
+def http_scope(path, headers=(), body=b'', cookie=None):
+    headers = [(key.lower().encode(), value.encode()) for key, value in headers]
+    if cookie:
+        headers.append((b'cookie', cookie.encode()))
+    if body:
+        headers.append((b'content-type', b'application/x-www-form-urlencoded'))
+    path, _, query = path.partition('?')
+    return {
+        'type': 'http',
+        'method': body and 'POST' or 'GET',
+        'path': path,
+        'query_string': query.encode(),
+        'headers': headers,
+    }
+
+
+def request(app, path, headers=(), body=b'', cookie=None):
+    """
+    Sends a request to the ASGI app, returning the status, headers and body of the response.
+    """
+    scope = http_scope(path, headers, body, cookie)
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    loop.run_until_complete(app(scope, receive, send))
+
+    start = messages[0]
+    response_headers = {key.decode(): value.decode() for key, value in start['headers']}
+    response_body = b''.join(message.get('body', b'') for message in messages[1:])
+    return start['status'], response_headers, response_body
+
+
+def event(app, cookie, view, event_type='click', detail=None):
+    triggering_event = urllib.parse.quote(json.dumps({'type': event_type, 'detail': detail}))
+    path = event_type == 'next' and '/loop' or '/event'
+    return request(app, path, headers=[
+        ('Hx-Trigger', view.id),
+        ('Triggering-Event', triggering_event),
+    ], body=b'x=1', cookie=cookie)
+
+
+@pytest.fixture
+def served():
+    views = {}
+
+    def serve(setup_func):
+        def setup(root):
+            views['button'] = View(parent=root, text='ready')
+            setup_func(views['button'])
+
+        app = asgi_app(setup)
+        status, headers, body = request(app, '/')
+        assert status == 200
+        cookie = headers['set-cookie'].split(';')[0]
+        return app, cookie, views['button']
+
+    return serve
+
+
+def test_index_sets_session(served):
+    app, cookie, button = served(lambda button: None)
+
+    assert cookie.startswith('ui4_session=')
+    assert cookie.split('=')[1] in Identity._views
+
+
+def test_async_handler(served):
+    def setup(button):
+        @button
+        async def on_click(view):
+            await asyncio.sleep(0)
+            view.text = 'done'
+
+    app, cookie, button = served(setup)
+    status, headers, body = event(app, cookie, button)
+
+    assert status == 200
+    assert 'done' in body.decode()
+
+
+def test_batched_async_events(served):
+    texts = []
+
+    def setup(button):
+        @button
+        async def on_input(view):
+            await asyncio.sleep(0)
+            texts.append(view._properties['value'])
+            view.text = view._properties['value']
+
+    app, cookie, button = served(setup)
+    body = json.dumps({'events': [
+        {'id': button.id, 'type': 'input', 'value': 'a'},
+        {'id': button.id, 'type': 'input', 'value': 'ab'},
+    ]}).encode()
+    status, headers, body = request(app, '/events', body=body, cookie=cookie)
+
+    assert status == 200
+    assert texts == ['a', 'ab']
+    assert 'ab' in body.decode()
+
+
+def test_async_generator_handler(served):
+    def setup(button):
+        @button
+        async def on_click(view):
+            view.text = 'first'
+            yield
+            await asyncio.sleep(0)
+            view.text = 'second'
+
+    app, cookie, button = served(setup)
+
+    status, headers, body = event(app, cookie, button)
+
+    assert 'first' in body.decode()
+    animation_id = next(iter(View._animation_generators))
+
+    status, headers, body = event(app, cookie, button, 'next', {'animationID': animation_id})
+
+    assert 'second' in body.decode()
+    assert not View._animation_generators
+
+
+def test_sweeper_leaves_active_sessions_alone(served, monkeypatch):
+    closed = []
+    live_during_handler = []
+
+    def setup(button):
+        @button
+        def on_click(view):
+            try:
+                yield
+            finally:
+                closed.append(True)
+
+        @button
+        async def on_input(view):
+            View._sweep_animations()
+            await asyncio.sleep(0)
+            live_during_handler.append(View.animation_metrics()['live'])
+
+    app, cookie, button = served(setup)
+    event(app, cookie, button)
+    monkeypatch.setattr(Events, 'animation_timeout', -1)
+
+    event(app, cookie, button, 'input')
+
+    assert live_during_handler == [1]
+    assert not closed
+
+    View._sweep_animations()
+
+    assert closed == [True]
+
+
+def test_requests_without_session_are_rejected(served):
+    app, cookie, button = served(lambda button: None)
+    views = dict(Identity._views)
+
+    for path in ('/event', '/loop', '/events', '/updates'):
+        status, headers, body = request(app, path, headers=[('Hx-Trigger', button.id)], body=b'x=1')
+        assert status == 410
+
+    assert Identity._views == views
+
+
+def test_static_assets(served):
+    app, cookie, button = served(lambda button: None)
+    status, headers, body = request(app, '/ui4.js', headers=[('Accept-Encoding', 'gzip')])
+
+    assert status == 200
+    assert headers['content-encoding'] == 'gzip'
+
+    status, headers, body = request(app, '/ui4.js', headers=[
+        ('Accept-Encoding', 'gzip'),
+        ('If-None-Match', headers['etag']),
+    ])
+
+    assert status == 304
+
+
+def stream_receive(disconnect):
+    """
+    Returns a receive function for a streamed response, which reports a disconnect once `disconnect` is set.
+    """
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    return receive
+
+
+def test_updates_are_pushed(served):
+    app, cookie, button = served(lambda button: None)
+    messages = []
+    receive = stream_receive(asyncio.Event())
+
+    async def send(message):
+        messages.append(message)
+
+    async def listen():
+        stream = asyncio.ensure_future(app(http_scope('/updates', cookie=cookie), receive, send))
+        while len(messages) < 2:
+            await asyncio.sleep(0)
+        button.text = 'pushed'
+        while len(messages) < 3:
+            await asyncio.sleep(0.01)
+        stream.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await stream
+
+    loop.run_until_complete(asyncio.wait_for(listen(), 5))
+
+    assert messages[0]['headers'] == [(b'cache-control', b'no-cache'), (b'content-type', b'text/event-stream')]
+    assert messages[1]['body'] == b': keepalive\n\n'
+    pushed = messages[2]['body'].decode()
+    assert pushed.startswith('data: ')
+    assert 'pushed' in pushed
+    assert not View._push_listeners
+
+
+def test_push_ends_on_disconnect(served):
+    app, cookie, button = served(lambda button: None)
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    async def listen():
+        disconnect = asyncio.Event()
+        stream = asyncio.ensure_future(app(http_scope('/updates', cookie=cookie), stream_receive(disconnect), send))
+        while len(messages) < 2:
+            await asyncio.sleep(0)
+        disconnect.set()
+        await stream
+
+    loop.run_until_complete(asyncio.wait_for(listen(), 5))
+
+    assert not View._push_listeners
+
+
+def test_async_handler_needs_async_processing():
+    view = View()
+
+    @view
+    async def on_click(view):
+        pass
+
+    with pytest.raises(TypeError):
+        view._process_event('click', view)
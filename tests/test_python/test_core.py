@@ -1,16 +1,34 @@
+import contextvars
+import gc
+import html
 import inspect
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
 from ui4 import landscape
 from ui4 import minimum
+from ui4.animation import _animation_context
 from ui4.animation import animation
+from ui4.animation import duration
+from ui4.core import Anchors
 from ui4.core import ConstraintExpression
 from ui4.core import Core
 from ui4.core import Events
+from ui4.core import Identity
+from ui4.core import StaleViewError
+from ui4.core import _current_user_id
 from ui4.core import at_least
 from ui4.core import at_most
 from ui4.core import delay
+from ui4.core import gap
+from ui4.core import run_ahead
+from ui4.core import session_of
+from ui4.textfield import TextField
+from ui4.view import View
 
 
 class TestIdentity:
@@ -29,6 +47,183 @@ class TestIdentity:
 
         assert Core.get_view(view2.id) == view2
 
+    def test_view_cap_drops_least_recently_used(self, monkeypatch):
+        monkeypatch.setattr(Identity, 'max_views_per_session', 2)
+        view1 = Core()
+        view2 = Core()
+
+        assert Core.get_view(view1.id) == view1  # Now most recently used
+
+        view3 = Core()
+
+        assert Core.get_view(view1.id) == view1
+        assert Core.get_view(view3.id) == view3
+        with pytest.raises(StaleViewError):
+            Core.get_view(view2.id)
+        assert Core.get_view('id100') is None
+
+    def test_view_cap_keeps_held_views(self, monkeypatch):
+        monkeypatch.setattr(Identity, 'max_views_per_session', 2)
+        root = Core()
+        Identity._hold(root)
+        child = Core(parent=root)
+        detached = Core()
+
+        Core()
+
+        assert Core.get_view(root.id) is root
+        assert Core.get_view(child.id) is child
+        with pytest.raises(StaleViewError):
+            Core.get_view(detached.id)
+
+    def test_ids_not_reused_after_release(self):
+        old_view = Core()
+        Identity._release_session()
+
+        view = Core()
+
+        assert view.id != old_view.id
+        with pytest.raises(StaleViewError):
+            Core.get_view(old_view.id)
+
+    def test_weak_views_collect_detached_subtrees(self, monkeypatch):
+        monkeypatch.setattr(Identity, 'weak_views', True)
+        root = Core()
+        Identity._hold(root)
+        parent = Core(parent=root)
+        child = Core(parent=parent)
+        child_id = child.id
+        del root, child
+
+        parent.parent = None
+        del parent
+        gc.collect()
+
+        assert Core.get_view('id1') is not None
+        with pytest.raises(StaleViewError):
+            Core.get_view(child_id)
+
+    def test_session_cap_releases_session_state(self, monkeypatch):
+        monkeypatch.setattr(Identity, 'max_sessions', 1)
+        monkeypatch.setattr(Identity, 'get_user_id', lambda: 'user1')
+        view = Core()
+        view._mark_dirty()
+
+        monkeypatch.setattr(Identity, 'get_user_id', lambda: 'user2')
+        Core()
+
+        assert 'user1' not in Identity._views
+        assert 'user1' not in Events._dirties
+        assert 'user2' in Identity._views
+
+    def test_idle_session_released(self, monkeypatch):
+        monkeypatch.setattr(Identity, 'session_idle_timeout', 10)
+        monkeypatch.setattr(Identity, 'get_user_id', lambda: 'user1')
+        Core()
+        Identity._last_access['user1'] -= 11
+
+        monkeypatch.setattr(Identity, 'get_user_id', lambda: 'user2')
+        Core()
+
+        assert list(Identity._views) == ['user2']
+
+    def test_mark_dirty_in_the_session_of_the_view(self, monkeypatch):
+        monkeypatch.setattr(Identity, 'get_user_id', lambda: 'user1')
+        view = Core()
+        notified = []
+        Events._push_listeners['user1'] = lambda: notified.append(True)
+
+        monkeypatch.setattr(Identity, 'get_user_id', lambda: 'user2')
+        view._mark_dirty()
+
+        assert Events._dirties['user1'] == {view}
+        assert 'user2' not in Events._dirties
+        assert notified == [True]
+
+    def test_session_lock(self):
+        lock = Identity._session_lock()
+
+        assert Identity._session_lock() is lock
+        assert Identity._session_lock('other user') is not lock
+
+        Identity._release_session()
+
+        assert Identity._session_lock() is lock  # Still in use
+
+    def test_session_cap_skips_busy_sessions(self, monkeypatch):
+        monkeypatch.setattr(Identity, 'max_sessions', 1)
+        monkeypatch.setattr(Identity, 'get_user_id', lambda: 'user1')
+        Core()
+        lock = Identity._session_lock('user1')
+
+        with ThreadPoolExecutor(1) as executor:
+            executor.submit(lock.acquire).result()
+            monkeypatch.setattr(Identity, 'get_user_id', lambda: 'user2')
+            Core()
+
+            assert 'user1' in Identity._views
+
+            executor.submit(lock.release).result()
+
+        Core()
+
+        assert 'user1' not in Identity._views
+
+    def test_views_created_outside_requests_join_parent_session(self):
+        _current_user_id.set('user1')
+        root = View()
+        root._render()
+        View._clear_dirties()
+
+        with ThreadPoolExecutor(1) as executor:
+            child = executor.submit(View, parent=root, text='from thread').result()
+
+        assert child._user_id == 'user1'
+        assert child.id == 'id2'
+        assert View.get_view(child.id) is child
+        assert child in View._get_dirties()
+
+    def test_session_of(self):
+        _current_user_id.set('user1')
+        root = View()
+        lock = Identity._session_lock()
+        entered = threading.Event()
+
+        def update():
+            with session_of(root):
+                entered.set()
+                return View().id, Identity.get_user_id()
+
+        with ThreadPoolExecutor(1) as executor:
+            with lock:
+                result = executor.submit(update)
+                assert not entered.wait(0.05)  # Waits for the request of the session
+            assert result.result() == ('id2', 'user1')
+
+            Identity._enter_async_request('user1')
+            entered.clear()
+            result = executor.submit(update)
+            assert not entered.wait(0.05)
+            Identity._exit_async_request('user1')
+            assert result.result() == ('id3', 'user1')
+
+        with session_of(root):  # Within a request of the session
+            assert View().id == 'id4'
+
+    def test_concurrent_sessions(self):
+        def create_views(user_id):
+            _current_user_id.set(user_id)
+            with Identity._session_lock():
+                return [Core().id for _ in range(200)]
+
+        user_ids = [f'user{i}' for i in range(8)]
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(create_views, user_ids))
+
+        assert all(ids == [f'id{i}' for i in range(1, 201)] for ids in results)
+        assert set(user_ids) <= set(Identity._views)
+        assert all(len(Identity._views[user_id]) == 200 for user_id in user_ids)
+
 
 class TestHierarchy:
 
@@ -82,6 +277,46 @@ class TestRender:
         for view_id in (parent.id, parent.container.id, child.id):
             assert view_id in render_result
 
+    def test_render_chunks(self):
+        parent = Core()
+        child = Core(parent=parent)
+        Core(parent=child)
+        Core(parent=parent)
+
+        chunks = list(parent._render_chunks())
+
+        assert len(chunks) == 6
+        parent._invalidate_render_cache()
+        assert ''.join(chunks) == parent._render()
+
+    def test_render_cache(self):
+        parent = Core()
+        child1 = Core(parent=parent)
+        child2 = Core(parent=parent)
+        parent._render()
+
+        assert parent._render_cache is not None
+
+        child1._set_css_property('alpha', 0.5, 'opacity', '0.5')
+
+        assert parent._render_cache is None
+        assert child1._render_cache is None
+        assert child2._render_cache is not None
+        assert 'opacity:0.5' in parent._render()
+
+        with animation():
+            child2._set_css_property('alpha', 0.5, 'opacity', '0.5')
+
+        assert 'ui4style' in parent._render()
+        assert parent._render_cache is None
+        assert 'ui4style' not in parent._render()
+        assert parent._render_cache is not None
+
+        child2.parent = None
+
+        assert parent._render_cache is None
+        assert child2.id not in parent._render()
+
 
 class TestConstraint:
 
@@ -196,6 +431,28 @@ class TestAnchorProperties:
 
         assert constraints(view3) == 'left=id2.left;right=id2.right'
 
+    def test_compact_constraints(self, anchor_view, monkeypatch):
+        monkeypatch.setattr(Anchors, 'compact_constraints', True)
+        view1 = anchor_view()
+        view2 = anchor_view()
+
+        view1.left = 100
+        view1.center_x = (view2.left + gap) * 2
+        view1.top = at_least(view2.bottom, 10 + 5)
+        with duration(1):
+            view1.height = view2.height
+
+        attributes = view1._render_anchors()
+
+        assert attributes['ui4'] == 'height=id2.height:1s'
+        assert json.loads(attributes['data-ui4c']) == [
+            ['left', '=', 100],
+            ['centerX', '=', ['*', ['+', 'id2.left', 'gap'], 2]],
+            ['top', '>', 'id2.bottom'],
+            ['top', '>', 15],
+        ]
+        assert minimum(view2.width, 3)._tree() == {'min': ['id2.width', 3]}
+
     def test_is_fixed(self, anchor_view):
         view1 = anchor_view()
         assert not view1._is_fixed()
@@ -272,6 +529,92 @@ class TestEvents:
         view1._mark_dirty()
         assert Core._get_roots() == {view1}
 
+    def test_get_roots_in_container(self):
+        frame = Core(container=Core())
+        child = Core(parent=frame)
+
+        frame.container._mark_dirty()
+        child._mark_dirty()
+        assert Core._get_roots() == {frame.container}
+
+    def test_incremental_updates(self):
+        parent = Core()
+        child = Core(parent=parent)
+        parent._render()
+        Core._clear_dirties()
+
+        child._set_css_property('alpha', 0.5, 'opacity', '0.5')
+        update = Events._render_updates(None)
+
+        assert f'id="{child.id}"' not in update
+        patches = json.loads(html.unescape(update.split('ui4patch="')[1].split('"')[0]))
+        assert patches == [{'id': child.id, 'attributes': {'style': 'opacity:0.5'}}]
+
+        assert Events._render_updates(None) == ''
+
+        new_child = Core(parent=parent)
+        new_child._mark_dirty()
+        update = Events._render_updates(None)
+
+        assert update.startswith(f'<div id="{parent.id}"')
+        assert 'ui4patch' not in update
+
+    def test_process_events_batch(self):
+        root = View()
+        field = TextField(parent=root)
+        label = View(parent=root)
+        values = []
+
+        @field
+        def on_input(data):
+            values.append(data.value)
+            label.text = data.value
+
+        root._render()
+        View._clear_dirties()
+        update = Events._process_events([
+            (field, 'input', 'a'),
+            (field, 'input', 'ab'),
+            (label, 'input', None),
+        ])
+
+        assert values == ['a', 'ab']
+        assert field.value == 'ab'
+        patches = json.loads(html.unescape(re.search(r'ui4patch="([^"]*)"', update).group(1)))
+        assert patches == [{'content': 'ab', 'id': label.id}]
+
+    def test_process_events_value_reset(self):
+        root = View()
+        field = TextField(parent=root, value='')
+
+        @field
+        def on_change(data):
+            data.value = ''
+
+        root._render()
+        View._clear_dirties()
+        update = Events._process_events([(field, 'change', 'abc')])
+
+        patches = json.loads(html.unescape(re.search(r'ui4patch="([^"]*)"', update).group(1)))
+        assert patches == [{'attributes': {'value': ''}, 'id': field.id}]
+
+    def test_process_events_batch_continues_latest_generator(self):
+        views = [Core(), Core()]
+        closed = []
+
+        for view in views:
+            @view
+            def on_click(data):
+                try:
+                    yield
+                finally:
+                    closed.append(data)
+
+        Events._process_events([(view, 'click', None) for view in views])
+
+        assert closed == views[:1]
+        assert Events.animation_metrics()['live'] == 1
+
     def test_event_generator(self):
         view = Core()
         assert view._animation_id is None
@@ -302,6 +645,130 @@ class TestEvents:
         view._process_event_loop(animation_id)
         assert view.value == 2
 
+    def test_event_generator_animation_context(self):
+        view = Core()
+        durations = []
+
+        @view
+        def on_click(data):
+            with duration(2):
+                durations.append(_animation_context().duration)
+                yield
+                durations.append(_animation_context().duration)
+
+        view._process_event('click', view)
+
+        assert _animation_context() is None
+
+        animation_id = next(iter(Events._animation_generators.keys()))
+        view._process_event_loop(animation_id)
+
+        assert durations == [2, 2]
+        assert _animation_context() is None
+
+    def test_event_generator_given_empty_context(self):
+        marker = contextvars.ContextVar('marker')
+        context = contextvars.Context()
+
+        def generator():
+            marker.set(1)
+            yield
+
+        Events._get_animation_loop(generator(), context)
+
+        assert context[marker] == 1
+
+    def test_run_ahead(self):
+        view = View()
+        view._render()
+
+        @view
+        @run_ahead
+        def on_click(data):
+            data.text = 'one'
+            with duration(0.5):
+                yield
+            data.text = 'two'
+            yield 2
+            data.text = 'three'
+
+        update = view._process_event('click', view)
+
+        assert view.text == 'three'
+        assert not Events._animation_generators
+        first, steps = update.split('<div id="ui4steps"')
+        assert '>one<' in first
+        assert re.findall(r'<template data-delay="([^"]*)">', steps) == ['0.5', '2']
+        assert steps.index('two') < steps.index('data-delay="2"') < steps.index('three')
+
+    def test_expired_animations_are_closed(self, monkeypatch):
+        view = Core()
+        closed = []
+
+        @view
+        def on_click(data):
+            with duration(1):
+                try:
+                    yield
+                finally:
+                    closed.append(_animation_context().duration)
+
+        view._process_event('click', view)
+        animation_id = next(iter(Events._animation_generators))
+
+        Events._sweep_animations()
+
+        assert Events.animation_metrics()['live'] == 1
+
+        monkeypatch.setattr(Events, 'animation_timeout', -1)
+        Events._sweep_animations()
+
+        assert closed == [1]
+        assert Events.animation_metrics() == dict(live=0, completed=0, expired=1, evicted=0, released=0)
+        assert view._process_event_loop(animation_id) == ''
+
+    def test_animations_per_session_cap(self, monkeypatch):
+        monkeypatch.setattr(Events, 'max_animations_per_session', 2)
+        view = Core()
+
+        @view
+        def on_click(data):
+            yield
+
+        for _ in range(3):
+            view._process_event('click', view)
+
+        assert Events.animation_metrics()['live'] == 2
+        assert Events.animation_metrics()['evicted'] == 1
+
+        Identity._release_session()
+
+        assert Events.animation_metrics()['live'] == 0
+        assert Events.animation_metrics()['released'] == 2
+
+    def test_run_ahead_max_steps(self, caplog):
+        view = Core()
+        closed = []
+
+        @view
+        @run_ahead(max_steps=2)
+        def on_click(data):
+            data.value = 0
+            try:
+                while True:
+                    data.value += 1
+                    yield 0
+            finally:
+                closed.append(True)
+
+        update = view._process_event('click', view)
+
+        assert view.value == 3
+        assert update.count('<template') == 2
+        assert closed == [True]
+        assert not Events._animation_generators
+        assert 'max_steps=2' in caplog.text
+
 
 
 
@@ -1,6 +1,8 @@
 import pytest
 
 from ui4 import Label
+from ui4.theme import DefaultTheme
+from ui4.theme import Style
 
 
 def test_dimension_combos():
@@ -17,10 +19,19 @@ def test_dimension_combos():
 
 def test_theme_style_fill():
     label = Label()
-    assert label._text_view._render_props() == {
-        'style':
-            'font-family:-apple-system,BlinkMacSystemFont,"Segoe '
-            'UI",Roboto,Helvetica,Arial,sans-serif,"Apple Color Emoji","Segoe UI '
-            'Emoji","Segoe UI Symbol";font-size:14px;color:rgba(0,0,0,255)',
+    assert label._text_view._render_props() == {'class': 'ui4-BaseStyle'}
+    assert label._render_props() == {
+        'class': 'ui4-BaseStyle',
+        'style': 'align-items:center;justify-content:center;padding:8px',
     }
-    assert label._render_props() == {'style': 'align-items:center;justify-content:center;padding:8px'}
+    assert label._text_view._render_attributes()['class'] == 'label-content ui4-BaseStyle'
+
+
+def test_theme_stylesheet(monkeypatch):
+    monkeypatch.setattr(Style, 'current_theme', DefaultTheme)
+    assert (
+        '.ui4-BaseStyle{'
+        'font-family:-apple-system,BlinkMacSystemFont,"Segoe '
+        'UI",Roboto,Helvetica,Arial,sans-serif,"Apple Color Emoji","Segoe UI '
+        'Emoji","Segoe UI Symbol";font-size:14px;color:rgba(0,0,0,255)}'
+    ) in Label._stylesheet().splitlines()
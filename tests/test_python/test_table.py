@@ -0,0 +1,104 @@
+import html
+import json
+import re
+
+from ui4 import VirtualTable
+from ui4 import View
+
+
+def rows(count):
+    return [[f'name {i}', i] for i in range(count)]
+
+
+def rendered_rows(table):
+    body = table._render().split('<table')[-1]
+    return [
+        re.findall(r'<td [^>]*>([^<]*)</td>', row)
+        for row in re.findall(r'<tr [^>]*>(.*?)</tr>', body)
+    ]
+
+
+def scroll(table, scroll_top, client_height):
+    window = table.children[-1]
+    return View._process_events([(window, 'scroll', f'{scroll_top},{client_height}')])
+
+
+def test_virtual_table_renders_window():
+    table = VirtualTable(content=rows(1000), heading_row_content=['name', 'value'], visible_rows=10, overscan=2)
+    rendered = table._render()
+
+    assert len(rendered_rows(table)) == 14
+    assert rendered_rows(table)[:2] == [['name 0', '0'], ['name 1', '1']]
+    assert 'height:32000px' in rendered
+    assert rendered.index('>name<') < rendered.index('overflow-y:auto')  # Heading outside of the scrolling
+
+
+def test_virtual_table_short_content():
+    table = VirtualTable(content=rows(3), visible_rows=10)
+    assert len(rendered_rows(table)) == 3
+
+    table.content = rows(5)
+    assert rendered_rows(table)[-1] == ['name 4', '4']
+
+    table.content = None
+    assert rendered_rows(table) == []
+
+
+def test_virtual_table_scroll_recycles_rows():
+    table = VirtualTable(content=rows(1000), visible_rows=10, overscan=2)
+    row_ids = re.findall(r'<tr id="(\w+)"', table._render())
+
+    scroll(table, 32 * 100, 320)
+
+    rendered = table._render()
+    assert table.first_row == 98
+    assert re.findall(r'<tr id="(\w+)"', rendered) == row_ids
+    assert rendered_rows(table)[0] == ['name 98', '98']
+    assert f'translateY({98 * 32}px)' in rendered
+
+    scroll(table, 32 * 10000, 320)
+
+    assert table.first_row == 1000 - 14
+    assert rendered_rows(table)[-1] == ['name 999', '999']
+
+
+def test_virtual_table_follows_window_height():
+    table = VirtualTable(content=rows(1000), heading_row_content=['name', 'value'], visible_rows=10, overscan=2)
+
+    scroll(table, 0, 32 * 20)
+
+    assert table.visible_rows == 20
+    assert len(rendered_rows(table)) == 24
+
+
+def test_virtual_table_scroll_event_patches_cells():
+    root = View()
+    table = VirtualTable(parent=root, content=rows(100), visible_rows=4, overscan=1)
+    window = table.children[-1]
+    assert 'scrollTop' in window._render_attributes()['hx-vars']
+
+    root._render()
+    View._clear_dirties()
+    update = scroll(table, 64, 128)
+
+    patches = json.loads(html.unescape(re.search(r'ui4patch="([^"]*)"', update).group(1)))
+    assert {'name 1', '1', 'name 6', '6'} <= {patch.get('content') for patch in patches}
+    assert f'id="{table.id}"' not in update
+
+
+def test_virtual_table_removed_rows_are_swapped_out():
+    root = View()
+    table = VirtualTable(parent=root, content=rows(100), visible_rows=10, overscan=2)
+    root._render()
+    View._clear_dirties()
+
+    update = scroll(table, 0, 100)
+
+    assert table.visible_rows == 4
+    assert len(re.findall(r'<tr ', update)) == 8
+
+    table.content = [[1, 2]]
+    update = View._render_updates(None)
+
+    assert len(re.findall(r'<tr ', update)) == 1
+    assert '>1</td>' in update
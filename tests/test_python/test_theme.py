@@ -1,9 +1,11 @@
 from ui4.core import Color
 from ui4.core import Core
+from ui4.theme import DefaultTheme
 from ui4.theme import Style
 from ui4.theme import Theme
 from ui4.theme import contrast
 from ui4.theme import theme
+from ui4.view import View
 
 
 class TestStyles:
@@ -51,9 +53,78 @@ class TestStyles:
         assert 'color' in view._css_properties
         assert len(view._css_properties) == 1
         
-        css_properties = view._set_position_and_fill_from_theme()
-        
-        assert 'background-color' in css_properties
-        assert len(css_properties) == 2
-        assert css_properties['background-color'] == Color('indigo').css
+        attributes = view._render_props()
+
+        assert attributes['class'] == Core._style_class_name(SomeStyle)
+        assert attributes['style'] == f"color:{Color('black').css}"
+        assert Core._theme_declarations(SomeStyle) == {'background-color': Color('indigo').css}
         
+
+    def test_theme_declarations(self, monkeypatch):
+        class SomeStyle(Style):
+            background_color = theme.background
+
+        class OneTheme(Theme):
+            background = Color('red')
+
+        class OtherTheme(Theme):
+            background = Color('blue')
+
+        monkeypatch.setattr(Style, 'current_theme', OneTheme)
+        declarations = Core._theme_declarations(SomeStyle)
+
+        assert declarations == {'background-color': Color('red').css}
+        assert Core._theme_declarations(SomeStyle) is declarations
+
+        monkeypatch.setattr(Style, 'current_theme', OtherTheme)
+
+        assert Core._theme_declarations(SomeStyle) == {'background-color': Color('blue').css}
+
+    def test_instance_properties_override_style(self, monkeypatch):
+        class SomeStyle(Style):
+            background_color = theme.background
+
+        class OneTheme(Theme):
+            background = Color('red')
+
+        monkeypatch.setattr(Style, 'current_theme', OneTheme)
+        view = View(style=SomeStyle)
+        view.background_color = 'green'
+
+        assert view._render_props() == {
+            'class': Core._style_class_name(SomeStyle),
+            'style': f"background-color:{Color('green').css}",
+        }
+
+    def test_style_class_names_are_unique(self):
+        def define_style():
+            class SomeStyle(Style):
+                pass
+            return SomeStyle
+
+        one, other = define_style(), define_style()
+
+        assert Core._style_class_name(one) != Core._style_class_name(other)
+        assert Core._style_class_name(one) == Core._style_class_name(one)
+
+    def test_stylesheet_update(self, monkeypatch):
+        class SomeStyle(Style):
+            background_color = theme.background
+
+        class OneTheme(DefaultTheme):
+            background = Color('red')
+
+        class OtherTheme(DefaultTheme):
+            background = Color('blue')
+
+        monkeypatch.setattr(Style, 'current_theme', OneTheme)
+        View._stylesheet_sent()
+
+        assert View._render_stylesheet_update() == ''
+
+        monkeypatch.setattr(Style, 'current_theme', OtherTheme)
+        update = View._render_stylesheet_update()
+
+        assert update.startswith('<style id="ui4styles" hx-swap-oob="true">')
+        assert f"background-color:{Color('blue').css}" in update
+        assert View._render_stylesheet_update() == ''
@@ -100,5 +100,6 @@ class TestView:
         view.font = 'Roboto', 'Arial', 'Verdana'
 
         assert view._render_props() == {
+            'class': 'ui4-BaseStyle',
             'style': 'font-family:Roboto,Arial,Verdana',
         }
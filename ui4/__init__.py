@@ -1,10 +1,14 @@
 from ui4.animation import animation, duration, ease
 from ui4.app import run
 from ui4.app import serve
+from ui4.app import wsgi
+from ui4.asgi import asgi_app
 from ui4.button import Button
 from ui4.card import Card
 from ui4.constants import *
 from ui4.core import gap, maximum, minimum, portrait, landscape, at_least, at_most
+from ui4.core import run_ahead
+from ui4.core import session_of
 from ui4.flow import FlowContainer
 from ui4.flow import FlowView
 from ui4.flow import GridContainer
@@ -13,6 +17,7 @@ from ui4.form import Form
 from ui4.label import Label
 from ui4.switch import Switch
 from ui4.table import Table
+from ui4.table import VirtualTable
 from ui4.textfield import TextField
 from ui4.theme import *
 from ui4.view import View
@@ -1,6 +1,5 @@
-import inspect
-
 from contextlib import contextmanager
+from contextvars import ContextVar
 from dataclasses import asdict
 from dataclasses import dataclass
 from math import inf
@@ -44,22 +43,17 @@ class AnimationSpec:
         )
 
 
-_ui4_animation_context_variable = '_ui4_animation_context_variable'
+# Innermost active animation spec, separate for each thread and asyncio task
+_animation_spec = ContextVar('ui4_animation_spec', default=None)
         
         
 def _animation(**kwargs):
-    frame = inspect.currentframe().f_back.f_back
-    animation_specs = frame.f_locals.get(_ui4_animation_context_variable, [])
-    prev_spec = animation_specs and animation_specs[-1] or AnimationSpec()
-    spec = prev_spec.merge(kwargs)
-    animation_specs.append(spec)
-    frame.f_locals[_ui4_animation_context_variable] = animation_specs
-
-    yield
-    
-    animation_specs.pop()
-    if not animation_specs:
-        del frame.f_locals[_ui4_animation_context_variable]
+    prev_spec = _animation_spec.get() or AnimationSpec()
+    token = _animation_spec.set(prev_spec.merge(kwargs))
+    try:
+        yield
+    finally:
+        _animation_spec.reset(token)
         
         
 @contextmanager
@@ -114,13 +108,7 @@ def iterations(iterations):
     
     
 def _animation_context() -> Optional[AnimationSpec]:
-    frame = inspect.currentframe()
-    while frame:
-        animation_specs = frame.f_locals.get(_ui4_animation_context_variable)
-        if animation_specs:
-            return animation_specs[-1]
-        frame = frame.f_back
-    return None
+    return _animation_spec.get()
 
 
 _animation_key_order = (
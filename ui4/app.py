@@ -1,5 +1,10 @@
+import gzip
+import hashlib
+import io
 import json
+import os
 import threading
+import time
 import uuid
 
 from pathlib import Path
@@ -9,15 +14,22 @@ import urllib.parse
 import flask
 from werkzeug.serving import make_server
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 from ui4.core import Identity
+from ui4.core import StaleViewError
+from ui4.core import _current_user_id
 from ui4.view import View
 
 
 class ServerThread(threading.Thread):
     
-    def __init__(self, flask_app, host, port):
+    def __init__(self, flask_app, host, port, threaded=True):
         threading.Thread.__init__(self)
-        self.server = make_server(host, port, flask_app)
+        self.server = make_server(host, port, flask_app, threaded=threaded)
         self.context = flask_app.app_context()
         self.context.push()
 
@@ -42,22 +54,196 @@ def capture_exceptions_in_tests(func):
         try:
             return func(self, *args, **kwargs)
         except BaseException as exception:
-            self.server.exception = exception
+            if getattr(self, 'server', None):
+                self.server.exception = exception
             raise
     return wrapper
 
 
-class FlaskRunner:
-    
+def session_locked(func):
+    """
+    Serializes the requests of a session, while requests of different sessions run concurrently.
+    """
+    def wrapper(self, *args, **kwargs):
+        with Identity._session_lock():
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def gzip_compress(content):
+    """
+    Compresses without a timestamp, so that the result only depends on the content.
+    """
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0) as gzip_file:
+        gzip_file.write(content)
+    return compressed.getvalue()
+
+
+class StaticAsset:
+    """
+    Static file loaded once at startup and served from memory, precompressed.
+
+    The URL carries a hash of the content, so that responses to it can be cached indefinitely.
+    """
+
+    # Preferred first
+    compressors = {
+        'gzip': gzip_compress,
+    }
+    if brotli:
+        compressors = {'br': brotli.compress, **compressors}
+
+    ONE_YEAR = 365 * 24 * 60 * 60  # seconds
+
+    def __init__(self, filename, mimetype='text/javascript'):
+        self.filename = filename
+        self.mimetype = mimetype
+        content = (Path(__file__).parent / 'static' / filename).read_bytes()
+        self.hash = hashlib.sha256(content).hexdigest()[:16]
+        self.encoded = {'identity': content}
+        for encoding, compress in self.compressors.items():
+            self.encoded[encoding] = compress(content)
+
+    @property
+    def url(self):
+        return f'{self.filename}?v={self.hash}'
+
+    def encoding_for(self, accepted_encodings):
+        return next(
+            (encoding for encoding in self.compressors if encoding in accepted_encodings),
+            'identity'
+        )
+
+    def etag(self, encoding):
+        return f'{self.hash}-{encoding}'
+
+    def response(self, request):
+        encoding = self.encoding_for(request.accept_encodings)
+        response = flask.Response(self.encoded[encoding], mimetype=self.mimetype)
+        if encoding != 'identity':
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        response.set_etag(self.etag(encoding))
+        if request.args.get('v') == self.hash:
+            response.cache_control.public = True
+            response.cache_control.max_age = self.ONE_YEAR
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+
+class Runner:
+    """
+    Parts shared by the servers: the page template and static scripts, loaded once at startup.
+
+    With `push_updates`, the page keeps a server-sent events channel open to /updates, and changes made to views
+    outside of requests are pushed to the browser, batched over `push_delay`. Make such changes within
+    `ui4.session_of(view)`, so that they do not race the requests of the session.
+    """
+
+    push_updates = False
+    push_delay = 0.05  # seconds
+    push_keepalive = 15  # seconds
+
     def __init__(self, protocol, host, port, quiet=False, **kwargs):
-        import os
         self.protocol = protocol
         self.host = host
         self.port = port
+        self.quiet = quiet
 
         self.app = None
         self._setup_func = None
-        
+
+        self.index_template = Template((Path(__file__).parent / 'static' / 'index_template.html').read_text())
+        self.js = StaticAsset('ui4.js')
+        self.parser = StaticAsset('ui4parser.js')
+
+    def _page(self):
+        """
+        Returns the page before and after the content of the root view.
+        """
+        head, tail = self.index_template.safe_substitute(
+            app_name=self.app.name,
+            gap=self.app.gap,
+            ui4_js=self.js.url,
+            ui4parser_js=self.parser.url,
+            styles=View._stylesheet_sent(),
+            push_updates=json.dumps(self.push_updates),
+            content=View._content_marker,
+        ).split(View._content_marker, 1)
+        return head, tail
+
+    @staticmethod
+    def _event_batch(events):
+        """
+        Returns the views for a batch of events coalesced by the browser, as a list of (view, event name, value)
+        tuples. Events of views that no longer exist are dropped, as the browser has already moved on.
+        """
+        batch = []
+        for event in events:
+            try:
+                view = View.get_view(event['id'])
+            except StaleViewError:
+                continue
+            if view is not None:
+                batch.append((view, event['type'], event.get('value')))
+        return batch
+
+    @staticmethod
+    def _push_message(updates):
+        lines = ''.join(f'data: {line}\n' for line in updates.split('\n'))
+        return f'{lines}\n'
+
+    _push_keepalive_message = ': keepalive\n\n'
+
+    # Size of the streamed body chunks, to avoid writing every view separately
+    chunk_size = 16 * 1024
+
+    def _chunked(self, fragments):
+        chunk = []
+        length = 0
+        for fragment in fragments:
+            chunk.append(fragment)
+            length += len(fragment)
+            if length >= self.chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                length = 0
+        if chunk:
+            yield ''.join(chunk)
+
+
+class FlaskRunner(Runner):
+    """
+    Serves the app with Flask.
+
+    Requests are handled in threads unless `threaded` is False. Sessions are identified with a signed cookie, so
+    the `secret_key` (or the UI4_SECRET_KEY environment variable) needs to be set for sessions to survive a
+    restart or to be shared between worker processes.
+
+    Pushing updates is off unless `push_updates` is set, and only available when threaded, as it keeps a thread
+    busy for every open page. With a fixed pool of threads, e.g. `gunicorn --threads 8`, pages open beyond the
+    size of the pool leave no threads for handling events; use `asgi_app` to push to many pages.
+    """
+    
+    def __init__(
+        self,
+        protocol,
+        host,
+        port,
+        quiet=False,
+        threaded=True,
+        debug=True,
+        secret_key=None,
+        push_updates=False,
+        **kwargs
+    ):
+        super().__init__(protocol, host, port, quiet, **kwargs)
+        self.threaded = threaded
+        self.push_updates = push_updates and threaded
+
         if quiet:
             import logging
             logging.getLogger('werkzeug').disabled = True
@@ -67,22 +253,26 @@ class FlaskRunner:
             'ui4server', 
             static_folder=str(Path(__file__).parent / 'static'),
         )
-        self.flask.secret_key = os.urandom(24)
-        Identity.get_user_id = self.current_user_id
+        self.flask.secret_key = secret_key or os.environ.get('UI4_SECRET_KEY') or os.urandom(24)
+        self.flask.before_request(self.set_current_user)
+        self.flask.teardown_request(self.reset_current_user)
+
+        self.flask.debug = debug
 
-        self.flask.debug = True
-        
         self.flask.add_url_rule('/', 'index', self.index)
         self.flask.add_url_rule('/ui4.js', 'send_js', self.send_js)
         self.flask.add_url_rule('/ui4parser.js', 'send_parser', self.send_parser)
         self.flask.add_url_rule('/event', 'handle_event', self.handle_event, methods=['GET', 'POST'])
         self.flask.add_url_rule('/loop', 'event_loop', self.event_loop, methods=['GET', 'POST'])
+        self.flask.add_url_rule('/events', 'handle_events', self.handle_events, methods=['POST'])
         self.flask.add_url_rule('/close', 'close_window', self.close_window)
+        if self.push_updates:
+            self.flask.add_url_rule('/updates', 'push_updates', self.send_updates)
         
     def run_server(self):
         self.server = None
         try:
-            self.server = ServerThread(self.flask, self.host, self.port)
+            self.server = ServerThread(self.flask, self.host, self.port, self.threaded)
             self.server.start()
         except BaseException as error:
             if self.server:
@@ -92,31 +282,96 @@ class FlaskRunner:
     def stop_server(self):
         self.server.shutdown()
         
+    # Endpoints that act on the views of the session, not served without one
+    session_endpoints = {'handle_event', 'event_loop', 'handle_events', 'push_updates'}
+
     @staticmethod
-    def current_user_id():
-        return flask.session['user_id']
+    def set_current_user():
+        user_id = flask.session.get('user_id')
+        if user_id is None:
+            if flask.request.endpoint == 'index':
+                user_id = flask.session['user_id'] = uuid.uuid4()
+            elif flask.request.endpoint in FlaskRunner.session_endpoints:
+                return 'No session, reload the page', 410
+        flask.g.ui4_user_token = _current_user_id.set(user_id)
+
+    @staticmethod
+    def reset_current_user(exception=None):
+        token = flask.g.pop('ui4_user_token', None)
+        if token:
+            _current_user_id.reset(token)
 
     @capture_exceptions_in_tests
     def index(self):
-        user_id = flask.session.setdefault('user_id', uuid.uuid4())
-        root = View(_css_class='rootApp')
-        self._setup_func(root)
-        template = Template((Path(__file__).parent / 'static' / 'index_template.html').read_text())
-        index_html = template.safe_substitute(
-            app_name=self.app.name,
-            gap=self.app.gap,
-            content=root._render()
+        with Identity._session_lock():
+            root = View(_css_class='rootApp')
+            Identity._hold(root)
+            self._setup_func(root)
+            head, tail = self._page()
+
+        def render_page():
+            yield head
+            with Identity._session_lock():
+                yield from self._chunked(root._render_chunks())
+                View._clear_dirties()
+            yield tail
+
+        return flask.Response(
+            flask.stream_with_context(self._capture_stream_exceptions(render_page())),
+            mimetype='text/html',
+        )
+
+    def _capture_stream_exceptions(self, chunks):
+        try:
+            yield from chunks
+        except BaseException as exception:
+            if getattr(self, 'server', None):
+                self.server.exception = exception
+            raise
+
+    def send_updates(self):
+        user_id = Identity.get_user_id()
+        changed = threading.Event()
+        notify = changed.set
+
+        def stream():
+            View._push_listeners[user_id] = notify
+            try:
+                yield self._push_keepalive_message
+                # Ends when the page is reloaded and opens a new channel
+                while View._push_listeners.get(user_id) is notify:
+                    if not changed.wait(self.push_keepalive):
+                        yield self._push_keepalive_message
+                        continue
+                    time.sleep(self.push_delay)
+                    changed.clear()
+                    # The stream is resumed outside of the context of the request
+                    token = _current_user_id.set(user_id)
+                    try:
+                        with Identity._session_lock(user_id):
+                            updates = View._render_updates(None)
+                    finally:
+                        _current_user_id.reset(token)
+                    if updates:
+                        yield self._push_message(updates)
+            finally:
+                if View._push_listeners.get(user_id) is notify:
+                    del View._push_listeners[user_id]
+
+        return flask.Response(
+            flask.stream_with_context(stream()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
         )
-        View._clear_dirties()
-        return index_html
 
     def send_js(self):
-        return self.flask.send_static_file('ui4.js')
+        return self.js.response(flask.request)
 
     def send_parser(self):
-        return self.flask.send_static_file('ui4parser.js')
+        return self.parser.response(flask.request)
 
     @capture_exceptions_in_tests
+    @session_locked
     def handle_event(self):
         view_id = flask.request.headers.get('Hx-Trigger')
         event_header_raw = flask.request.headers.get('Triggering-Event')
@@ -125,14 +380,24 @@ class FlaskRunner:
             event_name = json.loads(event_header)['type']
         else:
             event_name = 'load'  # Load events do not include a "Triggering-Event" header
-        view = View.get_view(view_id)
-        value = flask.request.values.get(view_id)
-        if value:
-            view._properties['value'] = value  # No update to front
+        try:
+            view = View.get_view(view_id)
+        except StaleViewError as error:
+            return str(error), 410
+        value = flask.request.values.get(view_id) or None
+
+        # Coalesced events that were still waiting in the browser are handled first, in order
+        batch = self._event_batch(json.loads(flask.request.values.get('ui4batch', '[]')))
+        return View._process_events(batch + [(view, event_name, value)])
 
-        return view._process_event(event_name, view)
+    @capture_exceptions_in_tests
+    @session_locked
+    def handle_events(self):
+        batch = self._event_batch(flask.request.get_json()['events'])
+        return View._process_events(batch)
 
     @capture_exceptions_in_tests
+    @session_locked
     def event_loop(self):
         view_id = flask.request.headers.get('Hx-Trigger')
         event_header = json.loads(urllib.parse.unquote(
@@ -191,24 +456,22 @@ class App:
         port=8080,
         **kwargs
     ):
-        super().__init__(
-            **kwargs)
         self.name = name
         self.gap = gap is None and self.DEFAULT_GAP or gap
         self.runner = (
-            runner_class and runner_class(protocol, host, port) or 
-            self._detect_runner(protocol, host, port)
+            runner_class and runner_class(protocol, host, port, **kwargs) or
+            self._detect_runner(protocol, host, port, **kwargs)
         )
         self.runner.app = self
         self.run_mode = 'serve'
 
-    def _detect_runner(self, protocol, host, port):
+    def _detect_runner(self, protocol, host, port, **kwargs):
         try:
-            return PythonistaRunner(protocol, host, port)
+            return PythonistaRunner(protocol, host, port, **kwargs)
         except ImportError:
             pass
 
-        return BrowserRunner(protocol, host, port)
+        return BrowserRunner(protocol, host, port, **kwargs)
 
     def run(self, setup_func):
         self.serve(setup_func)
@@ -232,3 +495,19 @@ def serve(setup_func, gap=None, **kwargs):
     app = App(gap=gap, **kwargs)
     app.serve(setup_func)
     return app
+
+
+def wsgi(setup_func, gap=None, **kwargs):
+    """
+    Returns a WSGI application for running the app under a production server, e.g. with
+    `gunicorn --threads 8 'module:wsgi_app'`, where `wsgi_app = ui4.wsgi(setup)`.
+
+    Sessions live in the memory of the worker process that served the page, so with several worker processes
+    the server or load balancer needs to send each session to the same worker (sticky sessions). Keyword
+    arguments are passed to `FlaskRunner`; set `secret_key` to share sessions between workers and restarts.
+    Leave `push_updates` off unless the server has a thread to spare for every open page.
+    """
+    kwargs.setdefault('debug', False)
+    app = App(gap=gap, runner_class=FlaskRunner, **kwargs)
+    app.runner._setup_func = setup_func
+    return app.runner.flask
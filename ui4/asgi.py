@@ -0,0 +1,351 @@
+"""
+ASGI server for apps with asynchronous event handlers.
+
+Event handlers can be plain functions and generators as with FlaskRunner, but also `async def` functions and
+async generators. The updates are rendered once the awaited work is done, and a session waiting on I/O does not
+hold up the other sessions served by the same process.
+
+Serve the app returned by `asgi_app` with any ASGI server, e.g. `uvicorn module:app`, or use `AsgiRunner` as the
+`runner_class` to start uvicorn in a thread like the other runners.
+"""
+import asyncio
+import contextlib
+import inspect
+import json
+import threading
+import urllib.parse
+import uuid
+import weakref
+from http.cookies import SimpleCookie
+
+from ui4.app import App
+from ui4.app import Runner
+from ui4.core import Identity
+from ui4.core import StaleViewError
+from ui4.core import _current_user_id
+from ui4.view import View
+
+
+class AsgiRequest:
+
+    def __init__(self, scope, body, receive=None):
+        self.body = body
+        self.receive = receive
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {
+            key.decode('latin-1').lower(): value.decode('latin-1')
+            for key, value in scope['headers']
+        }
+        self.args = self._parse_values(scope.get('query_string', b'').decode('latin-1'))
+        self.values = dict(self.args)
+        if self.headers.get('content-type', '').startswith('application/x-www-form-urlencoded'):
+            self.values.update(self._parse_values(body.decode()))
+        cookies = SimpleCookie(self.headers.get('cookie', ''))
+        self.cookies = {key: morsel.value for key, morsel in cookies.items()}
+
+    @staticmethod
+    def _parse_values(query):
+        return {key: values[-1] for key, values in urllib.parse.parse_qs(query).items()}
+
+    @property
+    def accept_encodings(self):
+        return {
+            encoding.split(';')[0].strip()
+            for encoding in self.headers.get('accept-encoding', '').split(',')
+        }
+
+
+class AsgiRunner(Runner):
+    """
+    Serves the app as an ASGI application.
+
+    Sessions are identified with a random session id in a cookie. Requests of a session are serialized with an
+    asyncio lock, while other sessions are served while a handler awaits. The session is marked active for the
+    duration of a request, so that the threads of the app, like the sweeper of suspended generators, leave it alone.
+    """
+
+    session_cookie = 'ui4_session'
+    push_updates = True
+    session_lock_poll_interval = 0.01  # seconds
+    session_paths = {'/event', '/loop', '/events', '/updates'}
+
+    def __init__(self, protocol, host, port, quiet=False, **kwargs):
+        super().__init__(protocol, host, port, quiet, **kwargs)
+        self.server = None
+        self._session_locks = weakref.WeakValueDictionary()
+        self.routes = {
+            '/': self.index,
+            '/ui4.js': self.send_js,
+            '/ui4parser.js': self.send_parser,
+            '/event': self.handle_event,
+            '/loop': self.event_loop,
+            '/events': self.handle_events,
+            '/close': self.close_window,
+            '/updates': self.send_updates,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        request = AsgiRequest(scope, await self._read_body(receive), receive)
+        handler = self.routes.get(request.path)
+        if not handler:
+            await self._respond(send, 'Not found', status=404, content_type='text/plain')
+            return
+
+        user_id = request.cookies.get(self.session_cookie)
+        if user_id is None and request.path in self.session_paths:
+            await self._respond(send, 'No session, reload the page', status=410, content_type='text/plain')
+            return
+        token = _current_user_id.set(user_id)
+        try:
+            await handler(request, send)
+        finally:
+            _current_user_id.reset(token)
+
+    def run_server(self):
+        try:
+            import uvicorn
+        except ImportError:
+            raise ImportError('AsgiRunner needs uvicorn to run a server: pip install uvicorn') from None
+
+        config = uvicorn.Config(
+            self,
+            host=self.host,
+            port=self.port,
+            log_level=self.quiet and 'warning' or 'info',
+            lifespan='off',
+        )
+        self.server = uvicorn.Server(config)
+        self.server_thread = threading.Thread(target=self.server.run, daemon=True)
+        self.server_thread.start()
+
+    def stop_server(self):
+        self.server.should_exit = True
+        self.server_thread.join()
+
+    def run(self):
+        import webbrowser
+
+        webbrowser.open(f'{self.protocol}://{self.host}:{self.port}')
+
+    def _session_lock(self):
+        user_id = Identity.get_user_id()
+        lock = self._session_locks.get(user_id)
+        if lock is None:
+            lock = self._session_locks[user_id] = asyncio.Lock()
+        return lock
+
+    @contextlib.asynccontextmanager
+    async def _session(self):
+        """
+        Holds the session for a request: serializes the requests of the session, and waits for a thread that is
+        already working on the session, like the sweeper closing a suspended generator.
+        """
+        user_id = Identity.get_user_id()
+        async with self._session_lock():
+            thread_lock = Identity._enter_async_request(user_id)
+            try:
+                while not thread_lock.acquire(blocking=False):
+                    await asyncio.sleep(self.session_lock_poll_interval)
+                thread_lock.release()
+                yield
+            finally:
+                Identity._exit_async_request(user_id)
+
+    async def index(self, request, send):
+        headers = []
+        if request.cookies.get(self.session_cookie) is None:
+            user_id = uuid.uuid4().hex
+            _current_user_id.set(user_id)
+            headers.append(
+                (b'set-cookie', f'{self.session_cookie}={user_id}; Path=/; HttpOnly; SameSite=Lax'.encode())
+            )
+
+        async with self._session():
+            root = View(_css_class='rootApp')
+            Identity._hold(root)
+            setup_result = self._setup_func(root)
+            if inspect.isawaitable(setup_result):
+                await setup_result
+            head, tail = self._page()
+
+            await self._start(send, 200, 'text/html; charset=utf-8', headers)
+            await self._send_body(send, head, more_body=True)
+            for chunk in self._chunked(root._render_chunks()):
+                await self._send_body(send, chunk, more_body=True)
+            View._clear_dirties()
+            await self._send_body(send, tail)
+
+    async def send_js(self, request, send):
+        await self._send_asset(request, send, self.js)
+
+    async def send_parser(self, request, send):
+        await self._send_asset(request, send, self.parser)
+
+    async def handle_event(self, request, send):
+        view_id = request.headers.get('hx-trigger')
+        event_header_raw = request.headers.get('triggering-event')
+        if event_header_raw:
+            event_header = urllib.parse.unquote(event_header_raw)
+            event_name = json.loads(event_header)['type']
+        else:
+            event_name = 'load'  # Load events do not include a "Triggering-Event" header
+
+        async with self._session():
+            try:
+                view = View.get_view(view_id)
+            except StaleViewError as error:
+                await self._respond(send, str(error), status=410, content_type='text/plain')
+                return
+            if view is None:
+                await self._respond(send, f'Unknown view {view_id}', status=404, content_type='text/plain')
+                return
+            value = request.values.get(view_id) or None
+
+            # Coalesced events that were still waiting in the browser are handled first, in order
+            batch = self._event_batch(json.loads(request.values.get('ui4batch', '[]')))
+            updates = await View._process_events_async(batch + [(view, event_name, value)])
+
+        await self._respond(send, updates)
+
+    async def handle_events(self, request, send):
+        async with self._session():
+            batch = self._event_batch(json.loads(request.body)['events'])
+            updates = await View._process_events_async(batch)
+
+        await self._respond(send, updates)
+
+    async def event_loop(self, request, send):
+        event_header = json.loads(urllib.parse.unquote(
+            request.headers.get('triggering-event')
+        ))
+        animation_id = event_header['detail']['animationID']
+
+        async with self._session():
+            updates = await View._process_event_loop_async(animation_id)
+
+        await self._respond(send, updates)
+
+    async def send_updates(self, request, send):
+        user_id = Identity.get_user_id()
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+
+        def notify():
+            loop.call_soon_threadsafe(changed.set)
+
+        View._push_listeners[user_id] = notify
+        disconnected = asyncio.ensure_future(self._disconnected(request.receive))
+        try:
+            await self._start(send, 200, 'text/event-stream', [(b'cache-control', b'no-cache')])
+            await self._send_body(send, self._push_keepalive_message, more_body=True)
+            # Ends when the page is closed, or reloaded and opens a new channel
+            while View._push_listeners.get(user_id) is notify:
+                change = asyncio.ensure_future(changed.wait())
+                done, pending = await asyncio.wait(
+                    {change, disconnected}, timeout=self.push_keepalive, return_when=asyncio.FIRST_COMPLETED
+                )
+                if disconnected in done:
+                    change.cancel()
+                    return
+                if change not in done:
+                    change.cancel()
+                    await self._send_body(send, self._push_keepalive_message, more_body=True)
+                    continue
+                await asyncio.sleep(self.push_delay)
+                changed.clear()
+                async with self._session():
+                    updates = View._render_updates(None)
+                if updates:
+                    await self._send_body(send, self._push_message(updates), more_body=True)
+            await self._send_body(send, '')
+        finally:
+            disconnected.cancel()
+            if View._push_listeners.get(user_id) is notify:
+                del View._push_listeners[user_id]
+
+    async def close_window(self, request, send):
+        await self._respond(send, '')
+        if self.app.run_mode == 'run' and self.server:
+            self.server.should_exit = True
+
+    async def _send_asset(self, request, send, asset):
+        encoding = asset.encoding_for(request.accept_encodings)
+        etag = f'"{asset.etag(encoding)}"'
+        if request.args.get('v') == asset.hash:
+            cache_control = f'public, max-age={asset.ONE_YEAR}, immutable'
+        else:
+            cache_control = 'no-cache'
+        headers = [
+            (b'vary', b'Accept-Encoding'),
+            (b'etag', etag.encode()),
+            (b'cache-control', cache_control.encode()),
+        ]
+        if encoding != 'identity':
+            headers.append((b'content-encoding', encoding.encode()))
+
+        if request.headers.get('if-none-match') == etag:
+            await self._start(send, 304, None, headers)
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        await self._start(send, 200, asset.mimetype, headers)
+        await send({'type': 'http.response.body', 'body': asset.encoded[encoding]})
+
+    @staticmethod
+    async def _disconnected(receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    @staticmethod
+    async def _read_body(receive):
+        body = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            body.append(message.get('body', b''))
+            more_body = message.get('more_body', False)
+        return b''.join(body)
+
+    @staticmethod
+    async def _start(send, status, content_type, headers=()):
+        headers = list(headers)
+        if content_type:
+            headers.append((b'content-type', content_type.encode()))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+
+    @staticmethod
+    async def _send_body(send, text, more_body=False):
+        await send({'type': 'http.response.body', 'body': text.encode(), 'more_body': more_body})
+
+    async def _respond(self, send, text, status=200, content_type='text/html; charset=utf-8'):
+        await self._start(send, status, content_type)
+        await self._send_body(send, text)
+
+    @staticmethod
+    async def _lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+def asgi_app(setup_func, gap=None, **kwargs):
+    """
+    Returns an ASGI application for running the app under an ASGI server, e.g. with `uvicorn 'module:app'`,
+    where `app = ui4.asgi_app(setup)`.
+
+    As with `wsgi`, sessions live in the memory of the process that served the page.
+    """
+    app = App(gap=gap, runner_class=AsgiRunner, **kwargs)
+    app.runner._setup_func = setup_func
+    return app.runner
@@ -1,21 +1,35 @@
 """
 Contains behind-the-scenes machinery that all views share.
 """
+import asyncio
+import contextvars
 import copy
+import html
+import inspect
 import json
+import logging
+import operator
+import threading
+import time
 import types
 import uuid
+import weakref
+from collections import OrderedDict
 from collections import defaultdict
+from collections import deque
 from collections.abc import Sequence
+from contextlib import contextmanager
 from functools import partial
 from functools import wraps
 from numbers import Number
 from string import Template
+from types import AsyncGeneratorType
 from types import GeneratorType
 
 from ui4.animation import _animation_context
 from ui4.animation import _animation_short_keys
 from ui4.color import Color
+from ui4.theme import Style
 from ui4.utils import decorator_argument_wrapper
 
 
@@ -23,24 +37,84 @@ def prop(func):
     return property(func, func)
 
 
+# Session of the request being handled, set by the runner
+_current_user_id = contextvars.ContextVar('ui4_user_id', default='c7d7ab3a-7ea1-46ab-8517-fe7cf9672fc7')
+
+
 def current_user_id():
-    return 'c7d7ab3a-7ea1-46ab-8517-fe7cf9672fc7'
+    return _current_user_id.get()
+
+
+class StaleViewError(LookupError):
+    """
+    Raised when looking up a view that existed in the session but is no longer available, because it has been
+    garbage collected or dropped to keep the session within its memory bounds.
+    """
     
 
+
 class Identity:
     """
     Contains logic for view identity.
+
+    Views are indexed per user session. Sessions are kept in least recently used order, and released when they
+    have been idle for too long or when there are too many of them. Within a session, the views that have been
+    least recently created or looked up are dropped from the index when the session has too many views, unless
+    they are part of a view tree held with `_hold`. The view cap is thus a safety limit for sessions that keep
+    creating views they no longer show, not a budget for the page.
+
+    View ids are never reused: sessions started after a release number their views past the ids issued so far,
+    so that events from a page of a released session are recognized as stale instead of reaching new views.
+
+    With `weak_views` set, the index only holds weak references, and views that are not reachable from one of
+    the roots held with `_hold` are garbage collected.
+
+    The session registry is guarded by `_registry_lock`. Requests hold the lock of their session while they touch
+    its views, so that sessions can be served concurrently while the requests of one session are serialized.
+    Sessions are only released while their lock is free, and a session lock lives as long as it is referenced,
+    so that the requests of a session always share one lock. Requests handled on an event loop cannot hold the
+    session lock across awaits, and mark their session active instead with `_enter_async_request`.
     """
-    _id_counter = defaultdict(int)
-    _views = defaultdict(dict)
+    _id_counter = {}
+    _id_floor = 0
+    _views = OrderedDict()
+    _last_access = {}
+    _roots = dict()
+    _session_releasers = []
+    _session_locks = weakref.WeakValueDictionary()
+    _active_sessions = defaultdict(int)
+    _registry_lock = threading.RLock()
     get_user_id = current_user_id
 
+    # Memory bounds, None for no limit
+    max_sessions = 1000
+    max_views_per_session = 100000
+    session_idle_timeout = 60 * 60  # seconds
+
+    weak_views = False
+    max_roots_per_session = 10
+    _trim_scan_limit = 100
+    _session_poll_interval = 0.01  # seconds
+
     def __init__(self, **kwargs):
+        # Views created outside of the requests of the session, e.g. in a timer thread, join the session of the parent
+        parent = getattr(self, '_parent', None)
         user_id = Identity.get_user_id()
-        self.id = self._get_next_id()
-        Identity._views[user_id][self.id] = self
+        token = None
+        if parent is not None and parent._user_id != user_id:
+            user_id = parent._user_id
+            token = _current_user_id.set(user_id)
+        try:
+            self.id = self._get_next_id()
+            self._user_id = user_id
+            views = Identity._session_views()
+            views[self.id] = self
+            Identity._trim_views(views)
 
-        self.apply(kwargs)
+            self.apply(kwargs)
+        finally:
+            if token is not None:
+                _current_user_id.reset(token)
 
     def apply(self, kwargs):
         for key, value in kwargs.items():
@@ -49,8 +123,7 @@ class Identity:
     @staticmethod
     def _get_next_id():
         user_id = Identity.get_user_id()
-        id_counter = Identity._id_counter[user_id]
-        id_counter += 1
+        id_counter = Identity._id_counter.get(user_id, Identity._id_floor) + 1
         Identity._id_counter[user_id] = id_counter
         return f'id{id_counter}'
     
@@ -58,10 +131,221 @@ class Identity:
     def get_view(view_id):
         """
         Get view object by id _for the current user_.
+
+        Returns None for ids that have never belonged to a view, and raises StaleViewError for views that are no
+        longer available.
+        """
+        views = Identity._session_views()
+        view = views.pop(view_id, None)
+        if view is not None:
+            views[view_id] = view  # Most recently used last
+        elif Identity._is_issued_id(view_id):
+            raise StaleViewError(f'View {view_id} is no longer available')
+        return view
+
+    @staticmethod
+    def _is_issued_id(view_id):
+        if not view_id or not view_id.startswith('id'):
+            return False
+        number = view_id[len('id'):]
+        return number.isdigit() and int(number) <= Identity._id_counter.get(Identity.get_user_id(), Identity._id_floor)
+
+    @staticmethod
+    def _hold(view):
+        """
+        Keeps the view, typically the root of a view tree, alive while its session lives, and the views in the
+        tree out of reach of the view cap.
+
+        Only the latest roots of each session are held.
+        """
+        user_id = Identity.get_user_id()
+        roots = Identity._roots.get(user_id)
+        if roots is None:
+            roots = Identity._roots[user_id] = deque(maxlen=Identity.max_roots_per_session)
+        roots.append(view)
+
+    @staticmethod
+    def _session_lock(user_id=None):
+        """
+        Returns the lock to hold while handling a request of the session.
+        """
+        if user_id is None:
+            user_id = Identity.get_user_id()
+        with Identity._registry_lock:
+            lock = Identity._session_locks.get(user_id)
+            if lock is None:
+                lock = Identity._session_locks[user_id] = threading.RLock()
+            return lock
+
+    @staticmethod
+    def _acquire_session(user_id):
+        """
+        Acquires the session lock for work outside of the requests of the session, waiting until no request of the
+        session is being handled in a thread or on an event loop.
+        """
+        while True:
+            with Identity._registry_lock:
+                if user_id not in Identity._active_sessions:
+                    lock = Identity._session_lock(user_id)
+                    if lock.acquire(blocking=False):
+                        return lock
+            time.sleep(Identity._session_poll_interval)
+
+    @staticmethod
+    def _enter_async_request(user_id):
+        """
+        Marks the session as handling a request on an event loop, which keeps the threads of the app from
+        releasing the session or closing its generators until `_exit_async_request`.
+
+        Returns the session lock, free of other threads once it can be acquired.
+        """
+        with Identity._registry_lock:
+            Identity._active_sessions[user_id] += 1
+            return Identity._session_lock(user_id)
+
+    @staticmethod
+    def _exit_async_request(user_id):
+        with Identity._registry_lock:
+            Identity._active_sessions[user_id] -= 1
+            if not Identity._active_sessions[user_id]:
+                del Identity._active_sessions[user_id]
+
+    @staticmethod
+    def _session_views():
+        """
+        Returns the view index of the current user, marking the session as the most recently used one.
         """
         user_id = Identity.get_user_id()
-        views = Identity._views.get(user_id)
-        return views.get(view_id)
+        with Identity._registry_lock:
+            views = Identity._views.get(user_id)
+            if views is None:
+                views = Identity._views[user_id] = weakref.WeakValueDictionary() if Identity.weak_views else {}
+            else:
+                Identity._views.move_to_end(user_id)
+            Identity._last_access[user_id] = time.monotonic()
+            evicted = Identity._evict_sessions()
+        Identity._finish_releases(evicted)
+        return views
+
+    @staticmethod
+    def _evict_sessions():
+        """
+        Releases the least recently used sessions while they are idle or above the session cap, skipping the
+        sessions that are handling a request in another thread or on an event loop.
+
+        Called under the registry lock. Returns the releases to finish with `_finish_releases` once the registry
+        lock has been released.
+        """
+        if not Identity._views:
+            return []
+        now = time.monotonic()
+        excess = Identity.max_sessions is not None and len(Identity._views) - Identity.max_sessions or 0
+
+        def is_idle(user_id):
+            return (
+                Identity.session_idle_timeout is not None and
+                now - Identity._last_access.get(user_id, now) > Identity.session_idle_timeout
+            )
+
+        if excess <= 0 and not is_idle(next(iter(Identity._views))):
+            return []
+
+        evicted = []
+        for user_id in list(Identity._views):
+            if excess <= 0 and not is_idle(user_id):
+                break
+            if user_id in Identity._active_sessions:
+                continue
+            lock = Identity._session_lock(user_id)
+            if not lock.acquire(blocking=False):
+                continue
+            evicted.append((lock, Identity._drop_session(user_id)))
+            excess -= 1
+        return evicted
+
+    @staticmethod
+    def _finish_releases(evicted):
+        """
+        Runs the finalizers of released sessions, each under the lock of its session.
+        """
+        for lock, finalizers in evicted:
+            try:
+                for finalize in finalizers:
+                    finalize()
+            finally:
+                lock.release()
+
+    @staticmethod
+    def _trim_views(views):
+        """
+        Drops the least recently used views that are not in a held view tree while the session is above the cap.
+
+        Views in a held tree are moved to the most recently used end as they are passed over, and only a limited
+        number of views is looked at per call, so that a page larger than the cap does not make every new view
+        scan the whole session.
+        """
+        if Identity.max_views_per_session is None:
+            return
+        excess = len(views) - Identity.max_views_per_session
+        if excess <= 0:
+            return
+        roots = Identity._roots.get(Identity.get_user_id(), ())
+        for _ in range(min(len(views), excess + Identity._trim_scan_limit)):
+            if excess <= 0:
+                break
+            view_id = next(iter(views))
+            view = views.pop(view_id)
+            if Identity._is_held(view, roots):
+                views[view_id] = view
+            else:
+                excess -= 1
+
+    @staticmethod
+    def _is_held(view, roots):
+        while getattr(view, '_parent', None) is not None:
+            view = view._parent
+        return any(view is root for root in roots)
+
+    @staticmethod
+    def _release_session(user_id=None):
+        """
+        Drops everything held for the session: views, id counter and the state registered with
+        `_register_release`. Ids issued to the session stay below the ids of sessions started later.
+
+        Waits for a request of the session being handled in another thread to finish.
+        """
+        if user_id is None:
+            user_id = Identity.get_user_id()
+        lock = Identity._session_lock(user_id)
+        lock.acquire()
+        with Identity._registry_lock:
+            finalizers = Identity._drop_session(user_id)
+        Identity._finish_releases([(lock, finalizers)])
+
+    @staticmethod
+    def _drop_session(user_id):
+        """
+        Drops the state of the session, returning the finalizers returned by the release functions.
+        """
+        with Identity._registry_lock:
+            Identity._views.pop(user_id, None)
+            Identity._last_access.pop(user_id, None)
+            Identity._id_floor = max(Identity._id_floor, Identity._id_counter.pop(user_id, 0))
+            Identity._roots.pop(user_id, None)
+            return [
+                finalize for finalize in (release(user_id) for release in Identity._session_releasers)
+                if finalize
+            ]
+
+    @classmethod
+    def _register_release(cls, f):
+        """
+        Decorator for registering functions that release per-session state, called with the user id under the
+        registry lock. Work that runs user code, like closing generators, is returned as a function to call once
+        the registry lock has been released.
+        """
+        cls._session_releasers.append(f)
+        return f
 
 
 class Hierarchy(Identity):
@@ -99,14 +383,21 @@ class Hierarchy(Identity):
                 new_parent = new_parent.container
             if self._parent:
                 self._parent._children.remove(self)
+                self._parent._children_changed()
             self._parent = new_parent
             if self._parent and self not in self._parent._children:
                 self._parent._children.append(self)
+                self._parent._children_changed()
         else:
             if self._parent and self._parent.is_container:
                 return self._parent._parent
             return self._parent
 
+    def _children_changed(self):
+        """
+        Called on a view when a child has been added or removed.
+        """
+
     @property
     def children(self):
         """
@@ -142,11 +433,29 @@ class Hierarchy(Identity):
 
 
 class Render(Hierarchy):
+    """
+    Renders views as HTML.
+
+    Each view caches its rendered HTML until it or one of its descendants changes, so that rendering a parent
+    only re-renders the changed parts of the tree. Invariant: if the cache of a view is valid, the caches of
+    all its descendants are valid as well.
+    """
     
     _renderers = []
     _template = Template('<$tag id="$id" $rendered_attributes $oob hx-swap="none">$content</$tag>')
     _css_class = None
     _tag = 'div'
+
+    # One-shot attributes, views rendering them are not cached
+    _volatile_attributes = ('ui4style',)
+
+    # Rendered attributes, children and result, None when not valid
+    _render_cache = None
+
+    # What was last sent to the browser, for incremental updates
+    _rendered_attributes = None
+    _rendered_children = None
+    _rendered_content = None
     
     def _render(self, htmx_oob=False, animation_id=None):
         """
@@ -159,27 +468,140 @@ class Render(Hierarchy):
         """
         self._animation_id = animation_id
 
-        attributes = self._subrenderer_results()
-
-        if self._css_class:
-            attributes['class'] = self._css_class
+        htmx_oob = htmx_oob and 'hx-swap-oob="true"' or ''
 
-        subrendered_attributes = ' '.join(
-            f"{key}='{value}'" for key, value
-            in attributes.items()
-        )
+        if self._render_cache is not None:
+            subrendered_attributes, rendered_children, render_result = self._render_cache
+            if htmx_oob:
+                render_result = self._render_result(subrendered_attributes, htmx_oob, rendered_children)
+            return render_result
 
-        htmx_oob = htmx_oob and 'hx-swap-oob="true"' or ''
+        attributes = self._render_attributes()
+        subrendered_attributes = self._join_attributes(attributes)
 
         # Must use private _children not to be fooled by a container view
         rendered_children = ''.join(
             child._render(animation_id=animation_id) for child in self._children
         )
 
+        self._record_rendered(attributes)
+
         render_result = self._render_result(subrendered_attributes, htmx_oob, rendered_children)
+
+        cacheable = (
+            not any(key in attributes for key in self._volatile_attributes) and
+            all(child._render_cache is not None for child in self._children)
+        )
+        if cacheable:
+            cached_result = (
+                self._render_result(subrendered_attributes, '', rendered_children) if htmx_oob
+                else render_result
+            )
+            self._render_cache = subrendered_attributes, rendered_children, cached_result
+
         #nprint(render_result)
         return render_result
-        
+
+    def _invalidate_render_cache(self):
+        """
+        Invalidates the cached HTML of the view and its ancestors.
+        """
+        view = self
+        while view is not None and view._render_cache is not None:
+            view._render_cache = None
+            view = view._parent
+
+    def _children_changed(self):
+        self._invalidate_render_cache()
+
+    def _render_chunks(self):
+        """
+        Renders the view like _render, but as a sequence of HTML fragments, rendering each child only when
+        the fragments before it have been consumed.
+
+        Used to stream the initial page, so that the browser can start loading scripts before the whole
+        view tree has been rendered.
+        """
+        if self._render_cache is not None or not self._children:
+            yield self._render()
+            return
+
+        attributes = self._render_attributes()
+        self._record_rendered(attributes)
+        opening, closing = self._render_result(
+            self._join_attributes(attributes), '', self._content_marker
+        ).split(self._content_marker, 1)
+
+        yield opening
+        for child in self._children:
+            yield from child._render_chunks()
+        yield closing
+
+    _content_marker = '<!--ui4-content-->'
+
+    @staticmethod
+    def _join_attributes(attributes):
+        return ' '.join(
+            f"{key}='{value}'" for key, value
+            in attributes.items()
+        )
+
+    def _record_rendered(self, attributes):
+        self._rendered_attributes = attributes
+        self._rendered_children = self._child_ids()
+        self._rendered_content = self._content()
+
+    def _render_attributes(self):
+        attributes = self._subrenderer_results()
+
+        if self._css_class:
+            attributes['class'] = ' '.join(filter(None, (self._css_class, attributes.get('class'))))
+
+        return attributes
+
+    def _child_ids(self):
+        return tuple(child.id for child in self._children)
+
+    def _content(self):
+        """
+        Returns the text content of a view without children, None for views with children.
+        """
+        if self._children:
+            return None
+        return getattr(self, 'text', None) or ''
+
+    def _render_patch(self):
+        """
+        Returns the changes to the view since it was last rendered, without its children, or None if
+        there are none.
+
+        Updates the record of what has been rendered.
+        """
+        attributes = self._render_attributes()
+        rendered_attributes = self._rendered_attributes
+        changed_attributes = {
+            key: value for key, value in attributes.items()
+            if rendered_attributes.get(key) != value
+        }
+        changed_attributes.update({
+            key: None for key in rendered_attributes
+            if key not in attributes
+        })
+        content = self._content()
+
+        self._rendered_attributes = attributes
+
+        patch = {}
+        if changed_attributes:
+            patch['attributes'] = changed_attributes
+        if content != self._rendered_content:
+            patch['content'] = content
+            self._rendered_content = content
+        if patch:
+            patch['id'] = self.id
+            return patch
+        return None
+
     def _subrenderer_results(self):
         subrenderer_results = {}
         for renderer in self._renderers:
@@ -219,13 +641,35 @@ class Events(Render):
     
     Event handlers can be generators, in which case browser gets a unique id
     that it uses to request the next step of the generator.
+
+    Views changed outside of a request, e.g. by a timer thread, are marked dirty in the session they belong to,
+    and the push listener of the session, if any, is notified to send them to the browser.
     """
     # Views that have changes
     _dirties = dict()
 
+    # Functions called when a view of the session is marked dirty, set by runners with a push channel
+    _push_listeners = dict()
+
     # Animation step generators
     _animation_generators = dict()
 
+    # Send only the changed attributes of views whose children have not changed
+    incremental_updates = True
+
+    # Ids of the animation step generators of each session, oldest first
+    _session_animations = defaultdict(dict)
+
+    # Suspended generators are closed when the browser has not asked for the next step within the timeout,
+    # or when the session has too many of them. None for no limit.
+    animation_timeout = 5 * 60  # seconds
+    max_animations_per_session = 100
+    animation_sweep_interval = 30  # seconds
+
+    # How the generators that are no longer suspended ended
+    _animation_counts = dict(completed=0, expired=0, evicted=0, released=0)
+    _sweeper = None
+
     def __init__(self, **kwargs):
         self._animation_id = None
         super().__init__(**kwargs)
@@ -239,6 +683,7 @@ class Events(Render):
         'on_click': 'click',
         'on_input': 'input',
         'on_load': 'load',
+        'on_scroll': 'scroll',
         # 'on_input_delay': 'input',
     }
 
@@ -253,6 +698,7 @@ class Events(Render):
             func.__name__.startswith('_internal_') and func.__name__[:len('_internal_')] in self._event_methods.keys()
         ):
             setattr(self, func.__name__, func)
+            self._invalidate_render_cache()
         else:
             raise ValueError(
                 f"{func.__name__} is not an event handler name: "
@@ -278,43 +724,363 @@ class Events(Render):
             'hx-trigger': trigger_str,
         } if trigger_str else {}
 
-    def _process_event(self, event_name, value=None):
-        animation_id = None
+    def _event_handlers(self, event_name):
         for method_name in (f'_internal_on_{event_name}', f'on_{event_name}'):
             event_method = getattr(self, method_name, None)
             if event_method:
-                animation_generator = event_method(value)
-                animation_id = None
-                if isinstance(animation_generator, GeneratorType):
+                yield event_method
+
+    def _process_event(self, event_name, value=None):
+        animation_id, run_ahead_updates = self._run_event_handlers(event_name, value)
+        return run_ahead_updates + Events._render_updates(animation_id)
+
+    @staticmethod
+    def _process_events(events):
+        """
+        Handles a batch of (view, event name, field value) events in order, rendering the updates once.
+
+        Field values are not None for events that carry the value of the field in the browser. A response
+        continues one generator, so generators left suspended by earlier events of the batch are closed.
+        """
+        animation_id = None
+        run_ahead_updates = ''
+        for view, event_name, value in events:
+            if value is not None:
+                view._receive_value(value)
+            event_animation_id, updates = view._run_event_handlers(event_name, view)
+            animation_id = Events._latest_animation(animation_id, event_animation_id)
+            run_ahead_updates += updates
+        return run_ahead_updates + Events._render_updates(animation_id)
+
+    def _receive_value(self, value):
+        """
+        Records the value of a field as shown in the browser, so that no update is sent for it, but setting it
+        back to the previously rendered value is.
+        """
+        self._properties['value'] = value
+        if self._rendered_attributes and 'value' in self._rendered_attributes:
+            self._rendered_attributes = dict(self._rendered_attributes, value=value)
+
+    @staticmethod
+    def _latest_animation(animation_id, event_animation_id):
+        """
+        Returns the id of the generator to continue after an event of a batch, closing the one it replaces.
+        """
+        if event_animation_id is None:
+            return animation_id
+        if animation_id is not None:
+            # Handled within the request of the session
+            Events._close_animation(animation_id, 'evicted', lock=False)
+        return event_animation_id
+
+    def _run_event_handlers(self, event_name, value=None):
+        """
+        Runs the handlers of the event, returning the id of the next step of a generator handler, if any, and
+        the updates rendered for handlers that ran ahead.
+        """
+        animation_id = None
+        run_ahead_updates = ''
+        for event_method in self._event_handlers(event_name):
+            animation_generator = event_method(value)
+            if inspect.isawaitable(animation_generator) or isinstance(animation_generator, AsyncGeneratorType):
+                if inspect.iscoroutine(animation_generator):
+                    animation_generator.close()
+                raise TypeError(f'{event_method.__name__} is async and needs to be served with AsgiRunner')
+            animation_id = None
+            if isinstance(animation_generator, GeneratorType):
+                max_steps = getattr(event_method, 'run_ahead', None)
+                if max_steps:
+                    updates, animation_id = Events._run_ahead(animation_generator, max_steps)
+                    run_ahead_updates += updates
+                else:
                     animation_id = Events._get_animation_loop(animation_generator)
 
-        return Events._render_updates(animation_id)
+        # Browser-side state like the value of a field may have changed without marking the view dirty
+        self._invalidate_render_cache()
+
+        return animation_id, run_ahead_updates
+
+    async def _process_event_async(self, event_name, value=None):
+        """
+        Like _process_event, but also accepts coroutine handlers and async generators. Updates are rendered
+        once the awaited work is done.
+        """
+        animation_id, run_ahead_updates = await self._run_event_handlers_async(event_name, value)
+        return run_ahead_updates + Events._render_updates(animation_id)
+
+    @staticmethod
+    async def _process_events_async(events):
+        animation_id = None
+        run_ahead_updates = ''
+        for view, event_name, value in events:
+            if value is not None:
+                view._receive_value(value)
+            event_animation_id, updates = await view._run_event_handlers_async(event_name, view)
+            animation_id = Events._latest_animation(animation_id, event_animation_id)
+            run_ahead_updates += updates
+        return run_ahead_updates + Events._render_updates(animation_id)
+
+    async def _run_event_handlers_async(self, event_name, value=None):
+        animation_id = None
+        run_ahead_updates = ''
+        for event_method in self._event_handlers(event_name):
+            animation_generator = event_method(value)
+            if inspect.isawaitable(animation_generator):
+                animation_generator = await animation_generator
+            animation_id = None
+            if isinstance(animation_generator, GeneratorType):
+                max_steps = getattr(event_method, 'run_ahead', None)
+                if max_steps:
+                    updates, animation_id = Events._run_ahead(animation_generator, max_steps)
+                    run_ahead_updates += updates
+                else:
+                    animation_id = Events._get_animation_loop(animation_generator)
+            elif isinstance(animation_generator, AsyncGeneratorType):
+                animation_id = await Events._get_async_animation_loop(animation_generator)
+
+        self._invalidate_render_cache()
+
+        return animation_id, run_ahead_updates
 
     @staticmethod
     def _process_event_loop(animation_id):
         # Get generator with the old id
-        animation_generator, yield_value = Events._animation_generators.pop(
-            animation_id
-        )
+        animation_generator, context = Events._take_animation(animation_id)
         # Return updates with the id of next step, or None if last
-        animation_id = Events._get_animation_loop(animation_generator)
+        if animation_generator:
+            animation_id = Events._get_animation_loop(animation_generator, context)
+        else:
+            animation_id = None  # Expired
 
         updates = Events._render_updates(animation_id)
         return updates
 
     @staticmethod
-    def _get_animation_loop(animation_generator):
-        animation_id = str(uuid.uuid4())
+    async def _process_event_loop_async(animation_id):
+        animation_generator, context = Events._take_animation(animation_id)
+        if isinstance(animation_generator, AsyncGeneratorType):
+            animation_id = await Events._get_async_animation_loop(animation_generator, context)
+        elif animation_generator:
+            animation_id = Events._get_animation_loop(animation_generator, context)
+        else:
+            animation_id = None  # Expired
+
+        return Events._render_updates(animation_id)
+
+    @staticmethod
+    def _take_animation(animation_id):
+        """
+        Returns the suspended generator and its context, or Nones if there is no such generator (anymore).
+        """
+        animation = Events._animation_generators.pop(animation_id, None)
+        if animation is None:
+            return None, None
+        animation_generator, yield_value, context, user_id, stored_at = animation
+        Events._session_animations[user_id].pop(animation_id, None)
+        return animation_generator, context
+
+    @staticmethod
+    def _get_animation_loop(animation_generator, context=None):
+        """
+        Runs the generator to its next yield.
+
+        Each generator runs in a context of its own, so that an animation block spanning a yield is active
+        in the later steps of the generator, but not in the code handling the request in between.
+        """
+        if context is None:
+            context = contextvars.copy_context()
         try:
-            yield_value = next(animation_generator)
-            Events._animation_generators[animation_id] = animation_generator, yield_value
+            yield_value = context.run(next, animation_generator)
         except StopIteration:
-            animation_id = None
+            Events._animation_counts['completed'] += 1
+            return None
+        return Events._store_animation(animation_generator, yield_value, context)
+
+    @staticmethod
+    def _store_animation(animation_generator, yield_value, context):
+        """
+        Keeps the generator until the browser asks for the next step, returning the id for the step.
+        """
+        animation_id = str(uuid.uuid4())
+        user_id = Identity.get_user_id()
+        Events._animation_generators[animation_id] = (
+            animation_generator, yield_value, context, user_id, time.monotonic()
+        )
+        session_animations = Events._session_animations[user_id]
+        session_animations[animation_id] = None
+        if (
+            Events.max_animations_per_session is not None and
+            len(session_animations) > Events.max_animations_per_session
+        ):
+            Events._close_animation(next(iter(session_animations)), 'evicted')
+        Events._start_sweeper()
         return animation_id
 
+    @staticmethod
+    def _close_animation(animation_id, reason, lock=True):
+        """
+        Drops the suspended generator, closing it so that its `finally` blocks and context managers run.
+        """
+        animation = Events._animation_generators.pop(animation_id, None)
+        if animation is None:
+            return
+        animation_generator, yield_value, context, user_id, stored_at = animation
+        Events._session_animations.get(user_id, {}).pop(animation_id, None)
+        Events._animation_counts[reason] += 1
+        if isinstance(animation_generator, GeneratorType):  # Async generators are closed by their event loop
+            if lock:
+                with Identity._session_lock(user_id):
+                    context.run(animation_generator.close)
+            else:
+                context.run(animation_generator.close)
+
+    @staticmethod
+    def _sweep_animations():
+        """
+        Closes the generators that have been suspended for longer than `animation_timeout`.
+
+        Generators of sessions that are handling a request are left for a later sweep.
+        """
+        if Events.animation_timeout is None:
+            return
+        now = time.monotonic()
+        # Stored in the order of suspension
+        for animation_id, animation in list(Events._animation_generators.items()):
+            if now - animation[-1] <= Events.animation_timeout:
+                break
+            user_id = animation[3]
+            with Identity._registry_lock:
+                if user_id in Identity._active_sessions:
+                    continue
+                lock = Identity._session_lock(user_id)
+                if not lock.acquire(blocking=False):
+                    continue
+            try:
+                Events._close_animation(animation_id, 'expired', lock=False)
+            finally:
+                lock.release()
+
+    @staticmethod
+    def _start_sweeper():
+        if Events._sweeper is not None or Events.animation_timeout is None:
+            return
+        with Identity._registry_lock:
+            if Events._sweeper is None:
+                Events._sweeper = threading.Thread(
+                    target=Events._run_sweeper, name='ui4-animation-sweeper', daemon=True
+                )
+                Events._sweeper.start()
+
+    @staticmethod
+    def _run_sweeper():
+        while True:
+            time.sleep(Events.animation_sweep_interval)
+            try:
+                Events._sweep_animations()
+            except Exception:
+                logging.getLogger(__name__).exception('Closing expired animation generators failed')
+
+    @staticmethod
+    def animation_metrics():
+        """
+        Returns the number of `live` suspended event handler generators, and counts of the generators that have
+        `completed`, `expired`, been `evicted` to keep within the per-session cap, or `released` with their
+        session.
+        """
+        return dict(live=len(Events._animation_generators), **Events._animation_counts)
+
+    @staticmethod
+    def _run_ahead(animation_generator, max_steps):
+        """
+        Runs the generator through its steps at once, rendering the updates of each step.
+
+        Returns the updates of the first step, followed by the later steps for the browser to apply on its own,
+        each after the delay of the step before it. A generator that has not finished after max_steps is closed,
+        as there is no step for the browser to continue from.
+        """
+        context = contextvars.copy_context()
+        try:
+            yield_value = context.run(next, animation_generator)
+        except StopIteration:
+            Events._animation_counts['completed'] += 1
+            return Events._render_updates(None), None
+        first_updates = Events._render_updates(None)
+
+        steps = []
+        while True:
+            delay = Events._step_delay(yield_value, context)
+            if len(steps) >= max_steps:
+                logging.getLogger(__name__).warning(
+                    'Closed %s after running ahead max_steps=%s steps', animation_generator.__name__, max_steps
+                )
+                context.run(animation_generator.close)
+                break
+            try:
+                yield_value = context.run(next, animation_generator)
+                finished = False
+            except StopIteration:
+                Events._animation_counts['completed'] += 1
+                finished = True
+            steps.append((delay, Events._render_updates(None)))
+            if finished:
+                break
+
+        return first_updates + Events._render_steps(steps), None
+
+    @staticmethod
+    def _step_delay(yield_value, context):
+        """
+        Seconds to wait after a step: the number yielded, or the duration of the animation active at the yield.
+        """
+        if isinstance(yield_value, Number) and not isinstance(yield_value, bool):
+            return yield_value
+        animation = context.run(_animation_context)
+        return animation and animation.duration or 0
+
+    @staticmethod
+    def _render_steps(steps):
+        if not steps:
+            return ''
+        templates = ''.join(
+            f'<template data-delay="{delay}">{updates}</template>'
+            for delay, updates in steps
+        )
+        return f'<div id="ui4steps" hx-swap-oob="true" hidden>{templates}</div>'
+
+    @staticmethod
+    async def _get_async_animation_loop(animation_generator, context=None):
+        """
+        Runs the async generator to its next yield, in a context of its own like _get_animation_loop.
+
+        Tasks run in a copy of the context they are created in, so the step hands back its context for the next
+        step.
+        """
+        if context is None:
+            context = contextvars.copy_context()
+        try:
+            yield_value, context = await context.run(asyncio.ensure_future, Events._async_step(animation_generator))
+        except StopAsyncIteration:
+            Events._animation_counts['completed'] += 1
+            return None
+        return Events._store_animation(animation_generator, yield_value, context)
+
+    @staticmethod
+    async def _async_step(animation_generator):
+        yield_value = await animation_generator.__anext__()
+        return yield_value, contextvars.copy_context()
+
+    def _children_changed(self):
+        super()._children_changed()
+        # A removed child leaves no dirty view behind to take it out of the browser
+        if self._rendered_attributes is not None:
+            self._mark_dirty()
+
     def _mark_dirty(self):
-        user_id = Identity.get_user_id()
-        Events._dirties.setdefault(user_id, set()).add(self)
+        self._invalidate_render_cache()
+        Events._dirties.setdefault(self._user_id, set()).add(self)
+        push_listener = Events._push_listeners.get(self._user_id)
+        if push_listener:
+            push_listener()
         
     @staticmethod
     def _get_dirties():
@@ -326,14 +1092,90 @@ class Events(Render):
         user_id = Identity.get_user_id()
         Events._dirties[user_id] = set()
 
+    @staticmethod
+    @Identity._register_release
+    def _release_session_events(user_id):
+        Events._dirties.pop(user_id, None)
+        Events._push_listeners.pop(user_id, None)
+        animation_ids = list(Events._session_animations.pop(user_id, ()))
+        if not animation_ids:
+            return None
+
+        def close_animations():
+            # Called holding the session lock
+            for animation_id in animation_ids:
+                Events._close_animation(animation_id, 'released', lock=False)
+
+        return close_animations
+
     @staticmethod
     def _render_updates(animation_id):
-        roots = Events._get_roots()
-        Events._clear_dirties()
+        stylesheet = CSSProperties._render_stylesheet_update()
+
+        if not Events.incremental_updates:
+            roots = Events._get_roots()
+            Events._clear_dirties()
+
+            return stylesheet + "".join(
+                root._render(htmx_oob=True, animation_id=animation_id)
+                for root in roots
+            )
+
+        # Taken in one step, as views can be marked dirty by other threads
+        dirties = Events._dirties.pop(Identity.get_user_id(), set())
 
-        return "".join(
+        return stylesheet + Events._render_incremental(dirties, animation_id)
+
+    @staticmethod
+    def _render_incremental(dirties, animation_id):
+        """
+        Renders changed attributes of the dirty views as a single patch, swapping whole subtrees only
+        where the children or the event handlers of a view have changed.
+
+        Views that have never been sent to the browser are swapped in with their closest rendered ancestor.
+        """
+        swapped = set()
+        for dirty in dirties:
+            view = dirty
+            while view and view._rendered_attributes is None:
+                view = view._parent
+            if view is None:
+                continue  # Not in the browser
+            if view is not dirty or dirty._needs_swap():
+                swapped.add(view)
+        swapped = Events._outermost(swapped)
+
+        patches = []
+        for dirty in dirties - Events._within(dirties, swapped):
+            if dirty._rendered_attributes is None:
+                continue
+            patch = dirty._render_patch()
+            if patch:
+                patches.append(patch)
+
+        rendered = [
             root._render(htmx_oob=True, animation_id=animation_id)
-            for root in roots
+            for root in swapped
+        ]
+        if patches:
+            patches_json = html.escape(json.dumps(patches, separators=(',', ':')))
+            rendered.append(f'<div id="ui4patch" hx-swap-oob="true" hidden ui4patch="{patches_json}"></div>')
+
+        return ''.join(rendered)
+
+    def _needs_swap(self):
+        """
+        Returns True if the view cannot be updated by patching its attributes.
+
+        htmx does not pick up changes to the hx- attributes of an existing element.
+        """
+        if self._rendered_children != self._child_ids():
+            return True
+        attributes = self._render_events()
+        return any(
+            self._rendered_attributes.get(key) != attributes.get(key)
+            for key in set(attributes).union(self._rendered_attributes)
+            if key.startswith('hx-')
         )
     
     @staticmethod    
@@ -341,17 +1183,48 @@ class Events(Render):
         """
         Get root views of the subtrees that need refreshing.
         """
-        roots = set()
-        dirties = Events._get_dirties()
-        for dirty in Events._get_dirties():
-            parent = dirty.parent
-            while parent:
-                if parent in dirties:
-                    break
-                parent = parent.parent
-            else:
-                roots.add(dirty)
-        return roots
+        return Events._outermost(Events._get_dirties())
+
+    @staticmethod
+    def _outermost(views):
+        """
+        Returns the views that do not have an ancestor among the views.
+        """
+        covered = {}
+        return {
+            view for view in views
+            if view._parent is None or not Events._is_covered(view._parent, views, covered)
+        }
+
+    @staticmethod
+    def _within(views, roots):
+        """
+        Returns the views that are roots or descendants of the roots.
+        """
+        covered = {}
+        return {view for view in views if Events._is_covered(view, roots, covered)}
+
+    @staticmethod
+    def _is_covered(view, roots, covered):
+        """
+        Returns True if the view or one of its ancestors is in roots.
+
+        The answer is remembered in covered for every view on the way up, so that checking many views of
+        the same tree visits each ancestor only once.
+        """
+        path = []
+        while view is not None and view not in roots and view not in covered:
+            path.append(view)
+            view = view._parent
+        if view is None:
+            result = False
+        elif view in roots:
+            result = True
+        else:
+            result = covered[view]
+        for passed in path:
+            covered[passed] = result
+        return result
 
     def remove_event(self, event_name):
         if not event_name in self._event_methods.values():
@@ -380,6 +1253,43 @@ def delay(func, seconds: float = 0.5):
     return set_event_options(func, delay=f'{float(seconds)}s')
 
 
+@decorator_argument_wrapper
+def run_ahead(func, max_steps: int = 100):
+    """
+    Run a generator event handler through its steps on the server at once, and let the browser apply the
+    steps on its own, each after the number of seconds yielded or the duration of the animation at the yield.
+
+    Views have their final values as soon as the handler returns. All the steps are rendered in one response, so
+    this is meant for animations of a known length: a generator still running after max_steps steps is closed,
+    with a warning, and views keep the values of the last step run.
+    """
+    func.run_ahead = max_steps
+    return func
+
+
+@contextmanager
+def session_of(view):
+    """
+    Runs the block in the session of the view, for changing views outside of the requests of the session, e.g. from
+    a timer or a thread reading a data feed.
+
+    The block waits for the requests of the session being handled to finish, and holds off new ones until it is
+    done. Views created in the block belong to the session, and with `push_updates` on, the changes are pushed to
+    the browser.
+    """
+    user_id = view._user_id
+    if Identity.get_user_id() == user_id:
+        yield  # Already in a request of the session
+        return
+    lock = Identity._acquire_session(user_id)
+    token = _current_user_id.set(user_id)
+    try:
+        yield
+    finally:
+        _current_user_id.reset(token)
+        lock.release()
+
+
 # @decorator_argument_wrapper
 # def queue(func, keyword: str):
 #     """
@@ -465,6 +1375,35 @@ class Constraint:
 
         return serialised
 
+    def compile(self, target):
+        """
+        Returns the constraint as a list of [target, comparison, tree] items that ui4.js can use without parsing,
+        or None if the constraint can only be sent serialized.
+
+        In the tree, numbers are numbers, "id.attribute" and "gap" strings are references, [operator, left, right]
+        lists are operations and {function name: [arguments]} dicts are function calls.
+        """
+        if self.condition or self.animation:
+            return None
+        tree = self._tree()
+        if tree is None:
+            return None
+        return [[target, self.comparison, tree]]
+
+    def _tree(self):
+        return Constraint._value_tree(self.value)
+
+    @staticmethod
+    def _value_tree(value):
+        """
+        Returns the compiled tree of a constraint or a number, None if it cannot be compiled.
+        """
+        if isinstance(value, Constraint):
+            return value._tree()
+        if isinstance(value, Number) and not isinstance(value, bool):
+            return value
+        return None
+
     def walk(self, function):
         result = function(self)
 
@@ -497,6 +1436,29 @@ class ConstraintExpression(Constraint):
 
         return f'{lhs}{self.value["operator"]}{rhs}'
 
+    # Functions for folding numbers like the ui4.js parser does
+    _operations = {
+        '+': operator.add,
+        '-': operator.sub,
+        '*': operator.mul,
+        '/': operator.truediv,
+    }
+
+    def _tree(self):
+        if self.value is None:
+            return self.initial_value == 'gap' and 'gap' or None
+        if type(self.value) is not dict:
+            return Constraint._value_tree(self.value)
+
+        lhs = Constraint._value_tree(self.value['lhs'])
+        rhs = Constraint._value_tree(self.value['rhs'])
+        operation = self._operations.get(self.value['operator'])
+        if lhs is None or rhs is None or operation is None:
+            return None
+        if isinstance(lhs, Number) and isinstance(rhs, Number):
+            return operation(lhs, rhs)
+        return [self.value['operator'], lhs, rhs]
+
     def _operator(self, operator, other):
         return ConstraintExpression({
             'operator': operator,
@@ -565,6 +1527,12 @@ class ConstraintFunction(ConstraintExpression):
     def __str__(self):
         return f'{self.function_name}({",".join(str(item) for item in self.parameters)})'
 
+    def _tree(self):
+        arguments = [Constraint._value_tree(item) for item in self.parameters]
+        if None in arguments:
+            return None
+        return {self.function_name: arguments}
+
     def walk(self, function):
         raise RuntimeError('Should not walk in a function')
 
@@ -589,6 +1557,14 @@ class ConstraintComposite(Constraint):
     def serialize(self, target):
         return ';'.join(f'{target}{self.comparison}{str(item)}' for item in self.value)
 
+    def compile(self, target):
+        if self.condition or self.animation:
+            return None
+        trees = [Constraint._value_tree(item) for item in self.value]
+        if None in trees:
+            return None
+        return [[target, self.comparison, tree] for tree in trees]
+
 at_least = ConstraintComposite('>')
 at_most = ConstraintComposite('<')
 
@@ -609,6 +1585,9 @@ class ConstraintAnchor(ConstraintExpression):
     def value(self, ignored_value):
         pass
 
+    def _tree(self):
+        return self.value
+
 
 class ConstraintCondition(Constraint):
 
@@ -652,6 +1631,10 @@ class Anchors(BasicProperties):
         'fit_width': 'fitWidth',
     }
 
+    # Send the constraints precompiled as JSON in a data-ui4c attribute, so that ui4.js does not need to parse
+    # them. Conditional and animated constraints are still sent in the ui4 attribute.
+    compact_constraints = False
+
     def __init__(self, gap=None, flow=False, **kwargs):
         self.flow = flow
         self._constraints = {}
@@ -676,6 +1659,9 @@ class Anchors(BasicProperties):
         
     @Render._register
     def _render_anchors(self):
+        if self.compact_constraints:
+            return self._render_compiled_anchors()
+
         constraints_str = ';'.join(
             constraint.serialize(self.to_js.get(attribute, attribute))
             for attribute, constraints_by_comparison in self._constraints.items()
@@ -691,6 +1677,28 @@ class Anchors(BasicProperties):
 
         return {'ui4': constraints_str}
 
+    def _render_compiled_anchors(self):
+        """
+        Renders the constraints that can be compiled in the data-ui4c attribute, and the rest serialized in the
+        ui4 attribute as usual.
+        """
+        compiled = []
+        serialized = []
+        for attribute, constraints_by_comparison in self._constraints.items():
+            target = self.to_js.get(attribute, attribute)
+            for constraints in constraints_by_comparison.values():
+                for constraint in constraints:
+                    dependencies = constraint.compile(target)
+                    if dependencies is None:
+                        serialized.append(constraint.serialize(target))
+                    else:
+                        compiled.extend(dependencies)
+
+        attributes = {'ui4': ';'.join(serialized)}
+        if compiled:
+            attributes['data-ui4c'] = json.dumps(compiled, separators=(',', ':'))
+        return attributes
+
     def _anchor_getter(self, attribute):
         return ConstraintAnchor(view=self, attribute=attribute)
 
@@ -927,6 +1935,16 @@ class CSSProperties(Anchors):
     style = None
     _css_value_funcs = {}
 
+    # Resolved theme CSS declarations by (style, theme)
+    _theme_tables = {}
+
+    # CSS class names of the Style classes, and the generated stylesheet with the styles and themes it covers
+    _style_class_names = weakref.WeakKeyDictionary()
+    _stylesheet_cache = None
+
+    # Styles and themes of the stylesheet last sent to each session
+    _session_stylesheets = {}
+
     def __init__(self, **kwargs):
         self._css_properties = {}
         self._css_transitions = {}
@@ -934,7 +1952,7 @@ class CSSProperties(Anchors):
 
     @Render._register
     def _render_props(self):
-        css_properties = self._set_position_and_fill_from_theme()
+        css_properties = self._inline_css_properties()
 
         styles = ";".join(
             f"{name}:{value}"
@@ -944,6 +1962,9 @@ class CSSProperties(Anchors):
 
         attributes = {}
 
+        if self.style:
+            attributes['class'] = self._style_class_name(self.style)
+
         if styles:
             attributes['style'] = styles
 
@@ -955,27 +1976,123 @@ class CSSProperties(Anchors):
 
         return attributes
 
-    def _set_position_and_fill_from_theme(self):
+    def _inline_css_properties(self):
+        """
+        Returns the CSS properties set on this view. Properties from the style are in the stylesheet.
+        """
         css_properties = dict(self._css_properties)
 
         if self._is_fixed():
             css_properties['position'] = 'absolute'
 
-        if not self.style:
-            return css_properties
+        return css_properties
 
-        for key in dir(self.style):
-            if key in css_properties or key.startswith('_'):
-                continue
-            css_spec = CSSProperties._css_value_funcs.get(key)
-            if css_spec:
-                css_name, css_value_func = css_spec
-                value = getattr(self.style, key)
-                if callable(value):
-                    value = value(self.style)
-                css_properties[css_name] = css_value_func(value)
+    @staticmethod
+    def _theme_declarations(style):
+        """
+        Returns the CSS declarations defined by the style, resolved against its current theme.
 
-        return css_properties
+        Resolved once per style and theme. Tables are dropped when new CSS properties are defined.
+        """
+        key = style, style.current_theme
+        declarations = CSSProperties._theme_tables.get(key)
+        if declarations is None:
+            declarations = {}
+            for name in dir(style):
+                css_spec = not name.startswith('_') and CSSProperties._css_value_funcs.get(name)
+                if css_spec:
+                    css_name, css_value_func = css_spec
+                    value = getattr(style, name)
+                    if callable(value):
+                        value = value(style)
+                    declarations[css_name] = css_value_func(value)
+            CSSProperties._theme_tables[key] = declarations
+        return declarations
+
+    @staticmethod
+    def _style_class_name(style):
+        """
+        Returns the CSS class name for the Style class, unique even if Style classes share a name.
+        """
+        class_name = CSSProperties._style_class_names.get(style)
+        if class_name is None:
+            with Identity._registry_lock:
+                class_name = f'ui4-{style.__name__}'
+                taken = set(CSSProperties._style_class_names.values())
+                suffix = 1
+                while class_name in taken:
+                    suffix += 1
+                    class_name = f'ui4-{style.__name__}-{suffix}'
+                CSSProperties._style_class_names.setdefault(style, class_name)
+            class_name = CSSProperties._style_class_names[style]
+        return class_name
+
+    @staticmethod
+    def _styles_and_themes():
+        styles = []
+        subclasses = deque(Style.__subclasses__())
+        while subclasses:
+            style = subclasses.popleft()
+            styles.append(style)
+            subclasses.extend(style.__subclasses__())
+        return tuple((style, style.current_theme) for style in styles)
+
+    @staticmethod
+    def _stylesheet():
+        """
+        Returns CSS rules for all Style classes under their current themes, with one class per Style.
+
+        Views refer to these with the class attribute, so that only properties set on the view itself
+        need to be rendered inline.
+        """
+        styles_and_themes = CSSProperties._styles_and_themes()
+        if CSSProperties._stylesheet_cache and CSSProperties._stylesheet_cache[0] == styles_and_themes:
+            return CSSProperties._stylesheet_cache[1]
+
+        rules = []
+        for style, _ in styles_and_themes:
+            declarations = ';'.join(
+                f'{css_name}:{css_value}'
+                for css_name, css_value in CSSProperties._theme_declarations(style).items()
+                if css_value is not None
+            )
+            if declarations:
+                rules.append(f'.{CSSProperties._style_class_name(style)}{{{declarations}}}')
+        stylesheet = '\n'.join(rules)
+
+        CSSProperties._stylesheet_cache = styles_and_themes, stylesheet
+        return stylesheet
+
+    @staticmethod
+    def _stylesheet_sent():
+        """
+        Returns the stylesheet for the page, recording it as sent to the session.
+        """
+        stylesheet = CSSProperties._stylesheet()
+        CSSProperties._session_stylesheets[Identity.get_user_id()] = CSSProperties._stylesheet_cache[0]
+        return stylesheet
+
+    @staticmethod
+    def _render_stylesheet_update():
+        """
+        Returns the stylesheet as an out-of-band swap if Style classes or themes have changed since the
+        session last received it, otherwise an empty string.
+        """
+        sent = CSSProperties._session_stylesheets.get(Identity.get_user_id())
+        if sent is None or sent == CSSProperties._styles_and_themes():
+            return ''
+        stylesheet = CSSProperties._stylesheet_sent()
+        return f'<style id="ui4styles" hx-swap-oob="true">{stylesheet}</style>'
+
+    @staticmethod
+    @Identity._register_release
+    def _release_session_stylesheet(user_id):
+        CSSProperties._session_stylesheets.pop(user_id, None)
+
+    @staticmethod
+    def _reset_theme_tables():
+        CSSProperties._theme_tables = {}
+        CSSProperties._stylesheet_cache = None
 
     def _set_css_property(
         self,
@@ -1000,6 +2117,7 @@ class CSSProperties(Anchors):
     @staticmethod
     def _css_func_prop(css_value_func, property_name, css_name):
         CSSProperties._css_value_funcs[property_name] = css_name, css_value_func
+        CSSProperties._reset_theme_tables()
         return property(
             lambda self: partial(
                 CSSProperties._getter, self, property_name,
@@ -1051,6 +2169,7 @@ class CSSProperties(Anchors):
             return value.css
 
         CSSProperties._css_value_funcs[property_name] = css_name, css_value_func
+        CSSProperties._reset_theme_tables()
         return property(
             lambda self: partial(
                 CSSProperties._getter, self, property_name,
@@ -1075,7 +2194,9 @@ class CSSProperties(Anchors):
 
         def setter(self, value):
             self._mark_dirty()
-            setattr(getattr(self, inner_view_attribute_name), property_name, value)
+            inner_view = getattr(self, inner_view_attribute_name)
+            inner_view._mark_dirty()
+            setattr(inner_view, property_name, value)
 
         return property(
             lambda self: getattr(getattr(self, inner_view_attribute_name), property_name),
@@ -1089,8 +2210,17 @@ class Core(CSSProperties):
     """
     @staticmethod
     def _clean_state():
-        Identity._id_counter = defaultdict(int)
-        Identity._views = defaultdict(dict)
+        Identity._id_counter = {}
+        Identity._id_floor = 0
+        Identity._views = OrderedDict()
+        Identity._last_access = {}
+        Identity._roots = dict()
+        Identity._session_locks = weakref.WeakValueDictionary()
+        Identity._active_sessions = defaultdict(int)
         Events._dirties = dict()
+        Events._push_listeners = dict()
         Events._animation_generators = dict()
+        Events._session_animations = defaultdict(dict)
+        Events._animation_counts = dict(completed=0, expired=0, evicted=0, released=0)
+        CSSProperties._session_stylesheets = {}
         # CSSProperties._css_value_funcs = {}
@@ -92,16 +92,48 @@ class UI4 {
     static KEYWORD = "keyword";
     static FUNCTION = "function";
 
+    // High-frequency events that are coalesced per view and sent to the server in batches
+    static batchedEvents = ["input", "scroll"];
+    static batchDelay = 50;  // ms
+
+    // Parsed source specs are cached as templates with the ids replaced by placeholders, least recently used
+    // dropped first
+    static parseCacheSize = 1000;
+
+    // Times the targets in a dependency cycle are checked before giving up on them settling
+    static maxCycleIterations = 4;
+
+    // Latest values kept per style of a target to detect values alternating between two values
+    static jitterHistorySize = 4;
+    // Changes smaller than this, in pixels, can be rounding error, larger ones are always applied
+    static jitterTolerance = 1;
+    static idAndAttributePattern = /([a-zA-Z\d_-]+)\.([a-zA-Z]+)/g;
+
     constructor() {
         this._gap = 8;
         this.idCounter = 0;
 
         this.allDependencies = {};
         this.sourceDependencies = {};
-        this.previousValues = {};
+        this.previousValues = new Map();
 
         this.layouts = {};
         this.gaps = {};
+        this.specs = {};  // Constraint attributes last parsed for each target
+
+        this.parseCache = new Map();
+        this.geometry = new Map();
+
+        this.resizeObserver = null;
+        this.observedElements = new Set();
+        this.pendingLayouts = new Set();
+        this.layoutFrame = null;
+
+        this.pendingSteps = [];  // Steps of run-ahead animations not applied yet, in order
+
+        this.pendingEvents = new Map();
+        this.batchTimer = null;
+        this.batchInFlight = false;
 
         const _this = this;
         this.getValue = {
@@ -165,6 +197,9 @@ class UI4 {
             }
         };
 
+        // Styles set earlier for the same target in the same pass are in `planned`, not yet in the DOM
+        const plannedOr = (planned, key, current) => key in planned ? parseFloat(planned[key]) : current();
+
         this.setValue = {
             width: function(context, value) { return {width: value + 'px'};},
             height: function(context, value) { return {height: value + 'px'};},
@@ -172,28 +207,28 @@ class UI4 {
             right: function(context, value) { return {right: context.parentElem.clientWidth - value + 'px'};},
             top: function(context, value) { return {top: value + 'px'};},
             bottom: function(context, value) { return {bottom: context.parentElem.clientHeight - value + 'px'};},
-            centerx: function(context, value) {
+            centerx: function(context, value, planned = {}) {
                 if (context.dependencies.find(item => item.targetAttribute === 'left')) {  // left locked, width must give
-                    return {width: 2 * (value - parseFloat(context.getStyle.left)) + 'px'};
+                    const left = plannedOr(planned, 'left', () => parseFloat(context.getStyle.left));
+                    return {width: 2 * (value - left) + 'px'};
                 } else if (context.dependencies.find(item => item.targetAttribute === 'right')) {  // width must give
-                    return {
-                        width: 2 * (context.parentElem.clientWidth -
-                            parseFloat(context.getStyle.right) - value) + 'px'
-                    };
+                    const right = plannedOr(planned, 'right', () => parseFloat(context.getStyle.right));
+                    return {width: 2 * (context.parentElem.clientWidth - right - value) + 'px'};
                 } else {  // Neither locked, move left
-                    return {left: value - context.targetElem.offsetWidth / 2 + 'px'};
+                    const width = plannedOr(planned, 'width', () => context.targetElem.offsetWidth);
+                    return {left: value - width / 2 + 'px'};
                 }
             },
-            centery: function(context, value) {
+            centery: function(context, value, planned = {}) {
                 if (context.dependencies.find(item => item.targetAttribute === 'top')) {  // top locked, height must give
-                    return {height: 2 * (value - parseFloat(context.getStyle.top)) + 'px'};
+                    const top = plannedOr(planned, 'top', () => parseFloat(context.getStyle.top));
+                    return {height: 2 * (value - top) + 'px'};
                 } else if (context.dependencies.find(item => item.targetAttribute === 'bottom')) {  // height must give
-                    return {
-                        height: 2 * context.parentElem.clientHeight -
-                            parseFloat(context.getStyle.bottom) - value + 'px'
-                    };
+                    const bottom = plannedOr(planned, 'bottom', () => parseFloat(context.getStyle.bottom));
+                    return {height: 2 * context.parentElem.clientHeight - bottom - value + 'px'};
                 } else {  // Neither locked, move top
-                    return {top: value - context.targetElem.offsetHeight / 2 + 'px'};
+                    const height = plannedOr(planned, 'height', () => context.targetElem.offsetHeight);
+                    return {top: value - height / 2 + 'px'};
                 }
             }
         };
@@ -244,19 +279,55 @@ class UI4 {
         return (parentDimension - ((total + 1) * gap)) / total * shareOf + ((shareOf - 1) * gap);
     }
 
-    setResizeObserver(node) {
-        const sourceID = node.id;
-        if (!sourceID) { return; }
-        const resizeObserver = new ResizeObserver(this.checkSourceDependencies.bind(this));
-        resizeObserver.observe(node);
+    observeElement(elem) {
+        // One observer for all the elements that other elements depend on
+        if (!elem || this.observedElements.has(elem)) { return; }
+        if (!this.resizeObserver) {
+            this.resizeObserver = new ResizeObserver(this.checkSourceDependencies.bind(this));
+        }
+        this.resizeObserver.observe(elem);
+        this.observedElements.add(elem);
+    }
+
+    unobserveElement(elem) {
+        if (this.observedElements.delete(elem)) {
+            this.resizeObserver.unobserve(elem);
+        }
+    }
+
+    removeSourceDependencies(targetId, sourceIDs) {
+        // Forget the target as a dependant of the sources, and the sources no longer needed
+        for (const sourceID of sourceIDs) {
+            const targetIds = this.sourceDependencies[sourceID];
+            if (!targetIds) { continue; }
+            delete targetIds[targetId];
+            if (!Object.keys(targetIds).length) {
+                delete this.sourceDependencies[sourceID];
+                this.unobserveElement(document.getElementById(sourceID));
+            }
+        }
+    }
+
+    scheduleLayout(targetId) {
+        // Lay out new and changed targets once per frame, with the targets depending on them
+        this.pendingLayouts.add(targetId);
+        if (this.layoutFrame === null) {
+            this.layoutFrame = requestAnimationFrame(() => {
+                this.layoutFrame = null;
+                const targetIds = this.pendingLayouts;
+                this.pendingLayouts = new Set();
+                this.solve(this.withDependants(targetIds));
+            });
+        }
     }
 
     startClassObserver() {
+        document.addEventListener("htmx:beforeSwap", () => this.finishSteps());
         const observer = new MutationObserver(this.classChangeHandler.bind(this));
         observer.observe(document, {
           subtree: true,
           childList: true,
-          attributeFilter: ["ui4"]
+          attributeFilter: ["ui4", "data-ui4c"]
         });
     }
 
@@ -265,22 +336,208 @@ class UI4 {
             switch (mutation.type) {
                 case 'childList':
                     mutation.addedNodes.forEach((node) => {
-                        if (node.getAttribute) {
+                        if (node.id === 'ui4patch') {
+                            this.applyPatches(node);
+                        }
+                        else if (node.id === 'ui4steps') {
+                            this.scheduleSteps(node);
+                        }
+                        else if (node.getAttribute) {
                             this.setDependencies(node);
-                            this.setResizeObserver(node);
                         }
                     });
+                    mutation.removedNodes.forEach((node) => this.forgetElements(node));
                     break;
-                case 'attributes':
+                case 'attributes':  // Changed constraints of the element, children have not changed
                     if (mutation.target.getAttribute) {
-                        this.setDependencies(mutation.target);
-                        this.setResizeObserver(mutation.target);
+                        this.setDependencies(mutation.target, false);
                     }
                     break;
             }
         });
     }
 
+    forgetElements(node) {
+        // Stop observing removed elements and forget the constraints of their ids. Ids of replaced elements are
+        // kept, and the replacements are observed again when they are added.
+        if (!node.querySelectorAll) { return; }
+        for (const elem of [node, ...node.querySelectorAll("[id]")]) {
+            this.unobserveElement(elem);
+            if (elem.id && !document.getElementById(elem.id)) {
+                this.forgetTarget(elem.id);
+            }
+        }
+    }
+
+    forgetTarget(targetId) {
+        // Sources stay known while other targets depend on them
+        this.removeSourceDependencies(targetId, this.sourceIDs(targetId));
+        delete this.allDependencies[targetId];
+        delete this.layouts[targetId];
+        delete this.gaps[targetId];
+        this.previousValues.delete(targetId);
+        this.pendingLayouts.delete(targetId);
+        delete this.specs[targetId];
+    }
+
+    isTarget(targetId) {
+        return targetId in this.allDependencies || targetId in this.layouts || targetId in this.gaps;
+    }
+
+    applyPatches(node) {
+        // Apply attribute and content changes sent by the server instead of whole elements
+        const patches = JSON.parse(node.getAttribute('ui4patch') || '[]');
+        for (const patch of patches) {
+            const elem = document.getElementById(patch.id);
+            if (!elem) {
+                continue;
+            }
+            for (const [name, value] of Object.entries(patch.attributes || {})) {
+                if (value === null) {
+                    elem.removeAttribute(name);
+                } else {
+                    elem.setAttribute(name, value);
+                }
+                if (name === 'value' && 'value' in elem) {  // Attribute alone does not update an edited field
+                    elem.value = value === null ? '' : value;
+                }
+            }
+            if (patch.attributes && 'style' in patch.attributes) {
+                // The new style attribute replaced the styles set by the layout as well, set them again
+                this.checkStyles(elem);
+                if (this.isTarget(elem.id)) {
+                    this.scheduleLayout(elem.id);
+                }
+            }
+            if ('content' in patch) {
+                elem.innerHTML = patch.content;
+            }
+        }
+    }
+
+    scheduleSteps(node) {
+        // Apply the steps of an animation the server ran ahead, each after the delay of the step before it
+        this.finishSteps();
+        let time = 0;
+        for (const step of Array.from(node.children)) {
+            time += parseFloat(step.dataset.delay) || 0;
+            const pending = {html: step.innerHTML};
+            pending.timer = setTimeout(() => {
+                this.pendingSteps.shift();
+                this.applyFragment(pending.html);
+            }, time * 1000);
+            this.pendingSteps.push(pending);
+        }
+    }
+
+    finishSteps() {
+        // Apply the steps still pending at once, before a newer response. The server has the values of the last
+        // step, so the response must not be overwritten by the steps, and the steps must not be dropped either.
+        const steps = this.pendingSteps;
+        this.pendingSteps = [];
+        for (const step of steps) {
+            clearTimeout(step.timer);
+            this.applyFragment(step.html);
+        }
+    }
+
+    startPushUpdates(url) {
+        // Receive updates the server pushes for changes made outside of requests
+        const source = new EventSource(url);
+        source.onmessage = (event) => {
+            this.finishSteps();
+            this.applyFragment(event.data);
+        };
+        return source;
+    }
+
+    startEventBatching() {
+        document.addEventListener("htmx:configRequest", this.batchEvent.bind(this));
+    }
+
+    batchEvent(event) {
+        // Hold back high-frequency events, keeping only the latest one per view, and send any still waiting
+        // along with the next other event so that the server sees them in order
+        const detail = event.detail;
+        if (detail.path !== "/event") return;
+        const elem = detail.elt;
+        const triggeringEvent = detail.triggeringEvent;
+        const type = triggeringEvent ? triggeringEvent.type : "load";
+        const value = elem.id in detail.parameters ? detail.parameters[elem.id] : elem.value;
+        if (UI4.batchedEvents.includes(type)) {
+            event.preventDefault();
+            this.pendingEvents.delete(elem.id);  // Keep the order of the latest events
+            this.pendingEvents.set(elem.id, {id: elem.id, type: type, value: value});
+            this.scheduleBatch();
+        } else if (this.batchInFlight) {
+            // Could overtake the batch, so sent in the next batch instead, right after the one in flight
+            event.preventDefault();
+            this.pendingEvents.set(Symbol(elem.id), {id: elem.id, type: type, value: value});
+        } else if (this.pendingEvents.size) {
+            detail.parameters.ui4batch = JSON.stringify(this.takePendingEvents());
+        }
+    }
+
+    hasHeldEvents() {
+        // Events other than the batched ones are not delayed any further than the batch in flight
+        return Array.from(this.pendingEvents.values()).some(pending => !UI4.batchedEvents.includes(pending.type));
+    }
+
+    scheduleBatch() {
+        if (this.batchTimer || this.batchInFlight) return;
+        this.batchTimer = setTimeout(() => {
+            this.batchTimer = null;
+            this.sendBatch();
+        }, UI4.batchDelay);
+    }
+
+    takePendingEvents() {
+        const events = Array.from(this.pendingEvents.values());
+        this.pendingEvents.clear();
+        return events;
+    }
+
+    sendBatch() {
+        // One batch at a time; events arriving meanwhile are coalesced into the next one
+        if (!this.pendingEvents.size) return;
+        this.batchInFlight = true;
+        fetch("/events", {
+            method: "POST",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({events: this.takePendingEvents()}),
+        })
+            .then((response) => response.ok ? response.text() : "")
+            .then((html) => {
+                this.finishSteps();
+                this.applyFragment(html);
+            })
+            .finally(() => {
+                this.batchInFlight = false;
+                if (this.hasHeldEvents()) {
+                    clearTimeout(this.batchTimer);
+                    this.batchTimer = null;
+                    this.sendBatch();
+                } else if (this.pendingEvents.size) {
+                    this.scheduleBatch();
+                }
+            });
+    }
+
+    applyFragment(html) {
+        // Swap in the elements of a pushed update by id, like htmx does with out-of-band elements
+        const template = document.createElement('template');
+        template.innerHTML = html;
+        for (const node of Array.from(template.content.children)) {
+            const existing = node.id && document.getElementById(node.id);
+            if (existing) {
+                existing.replaceWith(node);
+                if (window.htmx) {
+                    htmx.process(node);
+                }
+            }
+        }
+    }
+
     // startTracking() {
     //     const observer = new MutationObserver(this.checkDependencies.bind(this));
     //     observer.observe(document.body, {
@@ -291,7 +548,7 @@ class UI4 {
     //     this.checkDependencies();
     // }
 
-    setDependencies(node) {
+    setDependencies(node, recursive = true) {
         // We need the node to have an id from this point forward
         if (!node.id) {
             if (!node.getAttribute) return;
@@ -304,42 +561,51 @@ class UI4 {
         // const ui4AnimationID = node.getAttribute("ui4anim");
 
         const ui4Attr = this.checkStyles(node);
+        const compiledAttr = node.getAttribute("data-ui4c");
 
-        if (ui4Attr) {
-
+        // Sources are observed for size changes, including a replaced element of a source
+        if (targetId in this.sourceDependencies) {
+            this.observeElement(node);
+        }
 
-            let dependencies;
-            try {
-                dependencies = this.parseAndOrderDependencies(node, ui4Attr);
-            } catch(error) {
-                console.error(error);
-                return;
-            }
-            if (!dependencies.length) {
-                if (targetId in this.allDependencies) {
-                    for (const dependency of this.allDependencies[targetId]) {
-                        if (typeof dependency.value === 'object' && 'dependencyIDs' in dependency.value) {
-                            dependency.value.dependencyIDs.forEach(
-                                sourceID => delete this.sourceDependencies[sourceID][targetId]
-                            );
-                        }
+        if (ui4Attr || compiledAttr || this.isTarget(targetId)) {
+            // Parsing depends on the parent as well, for constraints like "dock=top"
+            const spec = `${node.parentElement ? node.parentElement.id : ""};${ui4Attr};${compiledAttr}`;
+            if (this.specs[targetId] !== spec) {  // Unchanged in a swapped element, most often
+                let dependencies = [];
+                delete this.layouts[targetId];  // Set again when parsed
+                delete this.gaps[targetId];
+                if (ui4Attr || compiledAttr) {
+                    try {
+                        dependencies = this.parseAndOrderDependencies(node, ui4Attr, compiledAttr);
+                    } catch(error) {
+                        console.error(error);
+                        return;
                     }
                 }
-                delete this.allDependencies[targetId];
-            } else {
-                this.allDependencies[targetId] = dependencies;
-                for (const dependency of dependencies) {
-                    if (typeof dependency.value === 'object' && 'dependencyIDs' in dependency.value) {
-                        dependency.value.dependencyIDs.forEach(
-                            sourceID => {
-                                const targetIds = this.sourceDependencies[sourceID] || {};
-                                targetIds[targetId] = true;
-                                this.sourceDependencies[sourceID] = targetIds;
-                            }
-                        );
-                    }
+                const previousSourceIDs = this.sourceIDs(targetId);
+                if (!dependencies.length) {
+                    delete this.allDependencies[targetId];
+                } else {
+                    this.allDependencies[targetId] = dependencies;
+                }
+                const sourceIDs = new Set(this.sourceIDs(targetId));
+                for (const sourceID of sourceIDs) {
+                    const targetIds = this.sourceDependencies[sourceID] || {};
+                    targetIds[targetId] = true;
+                    this.sourceDependencies[sourceID] = targetIds;
+                    this.observeElement(document.getElementById(sourceID));
+                }
+                this.removeSourceDependencies(
+                    targetId, previousSourceIDs.filter(sourceID => !sourceIDs.has(sourceID))
+                );
+                if (this.isTarget(targetId)) {
+                    this.specs[targetId] = spec;
+                } else {
+                    delete this.specs[targetId];
                 }
             }
+            this.scheduleLayout(targetId);
         }
         /*
         // Check animated styles
@@ -359,7 +625,9 @@ class UI4 {
         }
         */
         // Check children, since mutation observer only seems to pick the root of changes
-        node.childNodes.forEach(childNode => this.setDependencies(childNode));
+        if (recursive) {
+            node.childNodes.forEach(childNode => this.setDependencies(childNode));
+        }
     }
 
     checkStyles(node) {
@@ -367,7 +635,7 @@ class UI4 {
         const ui4Attr = this.combineConstraintAttributes(node);
         const isRootElem = node.classList.contains("ui4Root");
 
-        if (ui4Attr || isRootElem) {
+        if (ui4Attr || isRootElem || node.hasAttribute("data-ui4c")) {
             Object.assign(node.style, UI4.elementStyles);
         }
 
@@ -394,8 +662,11 @@ class UI4 {
         return constraintArray.join(";");
     }
 
-    parseAndOrderDependencies(node, specString) {
+    parseAndOrderDependencies(node, specString, compiledSpec) {
         const dependencies = this.parse(node, specString.replace(/\s/g,""));
+        if (compiledSpec) {
+            dependencies.push(...this.loadCompiled(node, compiledSpec));
+        }
 
         dependencies.sort((a, b) => UI4.ordering[a.comparison] - UI4.ordering[b.comparison]);
         return dependencies;
@@ -443,9 +714,50 @@ class UI4 {
         return dependencies;
     }
 
+    loadCompiled(node, compiledSpec) {
+        // Constraints precompiled by the server, as [target attribute, comparison, compact tree] items
+        const dependencies = [];
+        for (const [targetAttribute, comparison, compactTree] of JSON.parse(compiledSpec)) {
+            if (!(targetAttribute in this.setValue)) {
+                console.error(`Unknown target attribute: ${targetAttribute}`);
+                continue;
+            }
+            const sourceTree = this.expandCompiledTree(compactTree);
+            sourceTree.dependencyIDs = this.finalizeIdAndAttributeTree(node, targetAttribute, sourceTree);
+            dependencies.push({
+                targetAttribute: targetAttribute, comparison: comparison, value: sourceTree
+            });
+        }
+        return dependencies;
+    }
+
+    expandCompiledTree(compactTree) {
+        // Expand a compact tree to the nodes UI4.Parser produces
+        if (typeof compactTree === "number") {
+            return {type: UI4.NUMBER, value: compactTree};
+        }
+        if (typeof compactTree === "string") {
+            const [id, attribute] = compactTree.split(".");
+            return attribute === undefined ?
+                {type: UI4.KEYWORD, value: id} :
+                {type: UI4.ID_AND_ATTRIBUTE, value: {id: id, attribute: attribute}};
+        }
+        if (Array.isArray(compactTree)) {
+            const [operator, left, right] = compactTree;
+            return {
+                type: UI4.OPERATOR,
+                operator: operator,
+                left: this.expandCompiledTree(left),
+                right: this.expandCompiledTree(right)
+            };
+        }
+        const [functionName, args] = Object.entries(compactTree)[0];
+        return {type: UI4.FUNCTION, value: functionName, args: args.map(arg => this.expandCompiledTree(arg))};
+    }
+
     parseCoreSpec(node, targetAttribute, comparison, sourceSpec, dependencies) {
         if (targetAttribute in this.setValue) {
-            const sourceTree = new UI4.Parser().parse(sourceSpec);
+            const sourceTree = this.parseSourceSpec(sourceSpec);
             sourceTree.dependencyIDs = this.finalizeIdAndAttributeTree(node, targetAttribute, sourceTree);
             dependencies.push({
                 targetAttribute: targetAttribute, comparison: comparison, value: sourceTree
@@ -532,7 +844,7 @@ class UI4 {
             } else if (sourceSpec === "row") {
                 this.parseCoreSpec(node, 'layout', comparison, 'rows(1)', dependencies);
             } else {
-                sourceTree = new UI4.Parser().parse(sourceSpec);
+                sourceTree = this.parseSourceSpec(sourceSpec);
                 if (!(
                     sourceTree.type === UI4.FUNCTION &&
                     ['columns', 'rows'].includes(sourceTree.value) &&
@@ -555,6 +867,48 @@ class UI4 {
         }
     }
 
+    parseSourceSpec(sourceSpec) {
+        // Specs that differ only by ids, like "id3.right+gap" and "id8.right+gap", share one parsed template
+        const ids = [];
+        const template = sourceSpec.replace(UI4.idAndAttributePattern, (match, id, attribute) => {
+            let index = ids.indexOf(id);
+            if (index === -1) {
+                index = ids.push(id) - 1;
+            }
+            return `_${index}.${attribute}`;
+        });
+
+        let templateTree = this.parseCache.get(template);
+        if (templateTree === undefined) {
+            templateTree = new UI4.Parser().parse(template);
+            if (this.parseCache.size >= UI4.parseCacheSize) {
+                this.parseCache.delete(this.parseCache.keys().next().value);
+            }
+        } else {
+            this.parseCache.delete(template);  // Move to most recently used
+        }
+        this.parseCache.set(template, templateTree);
+
+        return this.instantiateTemplateTree(templateTree, ids);
+    }
+
+    instantiateTemplateTree(templateTree, ids) {
+        // Return a copy of the template tree with the actual ids, as the tree is modified when finalized
+        const tree = {...templateTree};
+        if (tree.type === UI4.ID_AND_ATTRIBUTE && typeof tree.value === "object") {
+            tree.value = {id: ids[parseInt(tree.value.id.substring(1))], attribute: tree.value.attribute};
+        }
+        for (const key of ["left", "right"]) {
+            if (tree[key]) {
+                tree[key] = this.instantiateTemplateTree(tree[key], ids);
+            }
+        }
+        if (tree.args) {
+            tree.args = tree.args.map(arg => this.instantiateTemplateTree(arg, ids));
+        }
+        return tree;
+    }
+
     parseBetweenSpec(node, sourceSpec, dependencies) {
         let attribute, minMax;
         for (const [dockAttribute, minmax] of Object.entries(UI4.betweenDock)) {
@@ -701,16 +1055,14 @@ class UI4 {
             );
         }
 
-        let sourceContext = {
+        return this.measure(sourceElem, attribute, contained, () => this.getValue[attribute]({
             contained: contained,
             getStyle: window.getComputedStyle(sourceElem),
             parentStyle: window.getComputedStyle(sourceElem.parentElement),
             targetElem: targetElem,
             sourceElem: sourceElem,
             parentElem: sourceElem.parentElement,
-        };
-
-        return this.getValue[attribute](sourceContext);
+        }));
     }
 
     startCSSAnimations(elem, styles) {
@@ -729,41 +1081,24 @@ class UI4 {
     }
 
     checkSourceDependencies(entries) {
-        const toCheck = [];
-        const seen = {};
-        let findDependants = [];
+        // Lay out the resized sources and everything that depends on them, directly or not
+        const sourceIds = new Set();
         entries.forEach(entry => {
             const sourceNode = entry.target;
-            if (sourceNode) {
-                const sourceID = sourceNode.id;
-                if (sourceID && !(sourceID in seen)) {
-                    toCheck.push(sourceID);
-                    findDependants.push(sourceID);
-                    seen[sourceID] = 1;
-                }
+            if (sourceNode && sourceNode.id) {
+                sourceIds.add(sourceNode.id);
             }
         });
+        this.solve(this.withDependants(sourceIds));
+    }
 
-        while (findDependants.length > 0) {
-            const toExpand = findDependants.shift();
-            const dependants = this.sourceDependencies[toExpand];
-            if (dependants) {
-                Object.keys(dependants).forEach(dependantID => {
-                    const seenCount = seen[dependantID] || 0;
-                    if (seenCount > 3) {  // Allow little circularity
-                        return;
-                    }
-                    toCheck.push(dependantID);
-                    findDependants.push(dependantID);
-                    seen[dependantID] = seenCount + 1;
-                });
-            }
-        }
-        for (const targetId of toCheck) {
-            if (targetId in this.allDependencies || targetId in this.layouts) {
-                this.checkDependenciesFor(targetId);
-            }
+    withDependants(ids) {
+        // Returns the ids with all the ids that depend on them, directly or not
+        const result = new Set(ids);
+        for (const id of result) {  // Set iteration includes the ids added during it
+            Object.keys(this.sourceDependencies[id] || {}).forEach(dependantId => result.add(dependantId));
         }
+        return result;
     }
 
     checkDependencies() {
@@ -771,55 +1106,222 @@ class UI4 {
     }
 
     checkAllDependencies() {
-        let redrawNeeded = false;
-        for (const [targetId, dependencies] of Object.entries(this.allDependencies)) {
-            redrawNeeded = this.checkDependenciesFor(targetId, dependencies);
+        this.solve(new Set([...Object.keys(this.allDependencies), ...Object.keys(this.layouts)]));
+    }
+
+    solve(targetIds) {
+        // Check each target once, after the targets it depends on. Only the targets in a dependency cycle
+        // are checked repeatedly, until their values settle.
+        // Targets that do not depend on each other are checked together, first reading all the geometry they
+        // need and then setting all their styles, so that the browser lays out the page once per level of
+        // dependencies instead of once per target.
+        for (const components of this.levels(this.orderTargets(targetIds))) {
+            const targets = [];
+            const cycles = [];
+            for (const component of components) {
+                const componentTargets = component.filter(
+                    targetId => targetId in this.allDependencies || targetId in this.layouts
+                );
+                if (component.length === 1) {
+                    targets.push(...componentTargets);
+                } else {
+                    cycles.push(componentTargets);
+                }
+            }
+
+            this.geometry.clear();
+            const measured = targets.map(targetId => this.measureTarget(targetId));
+            targets.forEach((targetId, index) => this.mutateTarget(targetId, measured[index]));
+            targets.forEach(targetId => this.applyLayout(targetId));
+
+            for (const cycle of cycles) {
+                for (let iteration = 0; iteration < UI4.maxCycleIterations; iteration++) {
+                    let changed = false;
+                    for (const targetId of cycle) {
+                        changed = this.checkDependenciesFor(targetId) || changed;
+                    }
+                    if (!changed) {
+                        break;
+                    }
+                }
+            }
         }
-        if (redrawNeeded) {
-            requestAnimationFrame(this.checkDependencies.bind(this));
+        this.geometry.clear();
+    }
+
+    levels(components) {
+        // Group the ordered components by their depth in the dependency graph
+        const levels = [];
+        const levelOf = new Map();
+        for (const component of components) {
+            let level = 0;
+            for (const targetId of component) {
+                for (const sourceId of this.sourceIDs(targetId)) {
+                    if (levelOf.has(sourceId) && !component.includes(sourceId)) {
+                        level = Math.max(level, levelOf.get(sourceId) + 1);
+                    }
+                }
+            }
+            component.forEach(targetId => levelOf.set(targetId, level));
+            (levels[level] = levels[level] || []).push(component);
         }
+        return levels.filter(level => level);
     }
 
-    checkDependenciesFor(targetId) {
-        let redrawNeeded = false;
-        if (targetId in this.allDependencies) {
-            let checkResults = this.checkResults(targetId);
+    sourceIDs(targetId) {
+        const sourceIDs = [];
+        for (const dependency of this.allDependencies[targetId] || []) {
+            if (typeof dependency.value === 'object' && 'dependencyIDs' in dependency.value) {
+                sourceIDs.push(...dependency.value.dependencyIDs);
+            }
+        }
+        return sourceIDs;
+    }
+
+    orderTargets(targetIds) {
+        // Strongly connected components of the dependency graph between the given ids, in dependency order.
+        // Components with more than one id are dependency cycles.
+        // Tarjan's algorithm, iterative to handle long dependency chains.
+        const dependantsOf = (id) => Object.keys(this.sourceDependencies[id] || {}).filter(
+            dependantId => dependantId !== id && targetIds.has(dependantId)  // Self-references are not cycles
+        );
+        const index = new Map();
+        const lowLink = new Map();
+        const stack = [];
+        const onStack = new Set();
+        const components = [];
+
+        const visit = (id, work) => {
+            index.set(id, index.size);
+            lowLink.set(id, index.get(id));
+            stack.push(id);
+            onStack.add(id);
+            work.push({id: id, dependants: dependantsOf(id), next: 0});
+        };
 
-            let finalValues = checkResults[0];
-            if (checkResults[1]) {
-                redrawNeeded = true;
+        for (const rootId of targetIds) {
+            if (index.has(rootId)) {
+                continue;
+            }
+            const work = [];
+            visit(rootId, work);
+            while (work.length) {
+                const frame = work[work.length - 1];
+                if (frame.next < frame.dependants.length) {
+                    const dependantId = frame.dependants[frame.next++];
+                    if (!index.has(dependantId)) {
+                        visit(dependantId, work);
+                    } else if (onStack.has(dependantId)) {
+                        lowLink.set(frame.id, Math.min(lowLink.get(frame.id), index.get(dependantId)));
+                    }
+                    continue;
+                }
+                work.pop();
+                if (work.length) {
+                    const parentId = work[work.length - 1].id;
+                    lowLink.set(parentId, Math.min(lowLink.get(parentId), lowLink.get(frame.id)));
+                }
+                if (lowLink.get(frame.id) === index.get(frame.id)) {
+                    const component = [];
+                    let memberId;
+                    do {
+                        memberId = stack.pop();
+                        onStack.delete(memberId);
+                        component.push(memberId);
+                    } while (memberId !== frame.id);
+                    components.push(component.reverse());  // In the order reached
+                }
             }
+        }
+
+        // Components are completed dependants first
+        return components.reverse();
+    }
+
+    checkDependenciesFor(targetId) {
+        // Returns true if any style of the target was changed
+        this.geometry.clear();
+        const changed = this.mutateTarget(targetId, this.measureTarget(targetId));
+        this.applyLayout(targetId);
+        return changed;
+    }
 
-            // Apply the final value for each attribute
+    measureTarget(targetId) {
+        // Returns the style updates for the target, only reading the DOM. Updates of an attribute that depend on
+        // the other styles of the target, like the center, see the updates of the attributes before it.
+        const measured = [];
+        if (targetId in this.allDependencies) {
+            const finalValues = this.checkResults(targetId)[0];
+            const planned = {};
             for (const [targetAttribute, data] of Object.entries(finalValues)) {
-                const updates = this.setValue[targetAttribute](data.context, data.sourceValue);
-                for (const [key, value] of Object.entries(updates)) {
-                    const oldValue = data.context.style[key]
-                    if (!oldValue) {
-                        data.context.style[key] = value;
-                        continue;
-                    }
+                const updates = this.setValue[targetAttribute](data.context, data.sourceValue, planned);
+                Object.assign(planned, updates);
+                measured.push({
+                    targetAttribute: targetAttribute,
+                    style: data.context.style,
+                    updates: updates,
+                });
+            }
+        }
+        return measured;
+    }
 
-                    // Remove oscillating jitter caused by floating point rounding error
-                    const valueAsNumber = parseFloat(value);
-                    const valueKey = `${targetId}.${targetAttribute}`;
-                    this.previousValues[valueKey] = this.previousValues[valueKey] || []
-                    const values = this.previousValues[valueKey];
-                    values.push(valueAsNumber);
-                    if (values.length === 6) {
-                        values.shift();
-                        const oddValue = new Set([values[1], values[3], values[5]]);
-                        const evenValue = new Set([values[1], values[3], values[5]]);
-                        if (!(oddValue.size === 1 && evenValue.size === 1 && oddValue.values()[0] === evenValue.values()[0])) {
-                            data.context.style[key] = value;
-                        }
-                    } else {
-                        data.context.style[key] = value;
-                    }
+    mutateTarget(targetId, measured) {
+        // Applies the measured style updates, returning true if any style was changed
+        let changed = false;
+        for (const {targetAttribute, style, updates} of measured) {
+            for (const [key, value] of Object.entries(updates)) {
+                const oldValue = style[key]
+                if (oldValue === value) {
+                    continue;
+                }
+                // Remove oscillating jitter caused by floating point rounding error
+                if (oldValue && this.isJitter(targetId, key, parseFloat(value))) {
+                    continue;
                 }
+                style[key] = value;
+                changed = true;
             }
         }
+        return changed;
+    }
+
+    isJitter(targetId, key, value) {
+        // True if the style keeps alternating between two values less than jitterTolerance apart and the new
+        // value is one of them. Otherwise records the value in a fixed size ring buffer of the latest values of
+        // the style, starting over after a larger change so that a real change never leaves a pattern behind.
+        let histories = this.previousValues.get(targetId);
+        if (!histories) {
+            histories = new Map();
+            this.previousValues.set(targetId, histories);
+        }
+        let history = histories.get(key);
+        if (!history) {
+            history = {values: new Array(UI4.jitterHistorySize), next: 0, count: 0};
+            histories.set(key, history);
+        }
+
+        const size = UI4.jitterHistorySize;
+        const latest = (stepsBack) => history.values[(history.next - 1 - stepsBack + size) % size];
+        if (history.count && Math.abs(value - latest(0)) >= UI4.jitterTolerance) {
+            history.next = 0;
+            history.count = 0;
+        }
+        if (
+            history.count === size &&
+            latest(0) === latest(2) && latest(1) === latest(3) && latest(0) !== latest(1) &&
+            (value === latest(0) || value === latest(1))
+        ) {
+            return true;
+        }
+
+        history.values[history.next] = value;
+        history.next = (history.next + 1) % size;
+        history.count = Math.min(history.count + 1, size);
+        return false;
+    }
 
+    applyLayout(targetId) {
         // Apply layouts, if any, to children, if any
         const layouts = this.layouts[targetId];
         if (layouts) {
@@ -832,8 +1334,20 @@ class UI4 {
                 this.grid_layout(container, undefined, layouts.args[0].value);
             }
         }
+    }
 
-        return redrawNeeded;
+    measure(elem, attribute, contained, getValue) {
+        // Geometry read during the current measure phase, read from the DOM only once
+        if (attribute.startsWith("fit")) {  // Depends on the target, not only on the source
+            return getValue();
+        }
+        const key = `${elem.id}.${attribute}.${contained}`;
+        let value = this.geometry.get(key);
+        if (value === undefined) {
+            value = getValue();
+            this.geometry.set(key, value);
+        }
+        return value;
     }
 
     checkResults(targetId) {
@@ -1015,7 +1529,9 @@ class UI4 {
         fullContext.sourceElem = targetContext.targetElem;
         fullContext.parentElem = targetContext.targetElem.parentElement;
         return {
-            value: this.getValue[targetAttribute](fullContext),
+            value: this.measure(
+                fullContext.sourceElem, targetAttribute, false, () => this.getValue[targetAttribute](fullContext)
+            ),
             type: UI4.attrType[targetAttribute],
             context: targetContext,
         };
@@ -1362,6 +1878,7 @@ UI4.Parser = class {
 var ui4 = new UI4();
 
 ui4.startClassObserver();
+ui4.startEventBatching();
 //window.onload = ui4.startTracking.bind(ui4);
 
 // Export only for tests under Node
@@ -1,3 +1,6 @@
+import math
+
+from ui4.prop import prop
 from ui4.theme import TableStyle
 from ui4.view import View
 
@@ -50,5 +53,155 @@ class Table(View):
         if heading_row_content:
             HeadingRow(parent=self, row_contents=heading_row_content)
 
-        for row_contents in content:
+        for row_contents in self.content:
             Row(parent=self, row_contents=row_contents)
+
+
+class RowWindow(View):
+    """
+    Scrolling area of a VirtualTable. Reports its scroll position and height when loaded and when scrolled.
+    """
+
+    def __init__(self, table, **kwargs):
+        super().__init__(**kwargs)
+        self.table = table
+        self._css_properties.update({
+            'position': 'absolute', 'left': '0', 'right': '0', 'bottom': '0', 'overflow-y': 'auto',
+        })
+
+    def _additional_attributes(self):
+        attributes = super()._additional_attributes()
+        element = f'document.getElementById("{self.id}")'
+        attributes['hx-vars'] = f'{self.id}:{element}.scrollTop+","+{element}.clientHeight'
+        return attributes
+
+    def _internal_on_load(self, view):
+        self._internal_on_scroll(view)
+
+    def _internal_on_scroll(self, view):
+        scroll_top, _, client_height = str(self._properties.get('value') or '0').partition(',')
+        self.table._scroll_to(float(scroll_top or 0), float(client_height or 0))
+
+
+class VirtualTable(View):
+    """
+    Table for long content, rendering only the rows in view.
+
+    The rows scroll in a window below the heading, over a spacer that is as tall as all the rows would be. A fixed
+    set of rows, enough to fill the window plus `overscan` rows on both sides, is moved along and refilled as the
+    window scrolls. Scroll positions arrive as coalesced scroll events, so only the cells that changed are sent to
+    the browser.
+
+    The number of rows in the window follows the height of the window reported by the browser, starting from
+    `visible_rows` until the first report. Rows have a fixed `row_height`, and cell values are shown as text.
+    """
+
+    # No vertical padding, so that the text fits in the fixed height of the rows
+    _cell_padding = '0 8px'
+
+    def __init__(self, content=None, heading_row_content=None, row_height=32, visible_rows=20, overscan=5, **kwargs):
+        super().__init__()
+        self.row_height = row_height
+        self.overscan = overscan
+        self._properties['visible_rows'] = visible_rows
+        self._content_rows = list(content or [])
+        self._first_row = 0
+        self._css_properties['position'] = 'relative'  # For the heading and the window, unless laid out
+
+        heading_height = 0
+        if heading_row_content:
+            heading_height = row_height
+            heading = Table(parent=self, heading_row_content=heading_row_content)
+            heading._css_properties.update({
+                'position': 'absolute', 'top': '0', 'left': '0', 'width': '100%', 'table-layout': 'fixed',
+            })
+            heading_row = heading.children[0]
+            heading_row._css_properties['height'] = f'{row_height}px'
+            for cell in heading_row.children:
+                cell.padding = self._cell_padding
+
+        self._window = RowWindow(self, parent=self)
+        self._window._css_properties['top'] = f'{heading_height}px'
+        self._spacer = View(parent=self._window)
+        self._spacer._css_properties.update({'position': 'relative', 'overflow': 'visible'})
+        self._body = Table(parent=self._spacer)
+        self._body._css_properties.update({
+            'position': 'absolute', 'top': '0', 'left': '0', 'width': '100%', 'table-layout': 'fixed',
+        })
+
+        self.apply(kwargs)
+        self._refresh()
+
+    @prop
+    def content(self, *value):
+        if not value:
+            return self._content_rows
+
+        self._content_rows = list(value[0] or [])
+        self._first_row = min(self._first_row, self._max_first_row())
+        self._refresh()
+
+    @prop
+    def visible_rows(self, *value):
+        """
+        Number of rows that fit in the window, used to size the set of rendered rows.
+        """
+        if not value:
+            return self._properties.get('visible_rows')
+
+        self._properties['visible_rows'] = value[0]
+        self._first_row = min(self._first_row, self._max_first_row())
+        self._refresh()
+
+    @property
+    def first_row(self):
+        """
+        Index of the first rendered row in `content`.
+        """
+        return self._first_row
+
+    def _scroll_to(self, scroll_top, client_height=0):
+        if client_height > 0:
+            self._properties['visible_rows'] = math.ceil(client_height / self.row_height)
+        first_row = max(0, int(scroll_top // self.row_height) - self.overscan)
+        self._first_row = min(first_row, self._max_first_row())
+        self._refresh()
+
+    def _window_size(self):
+        return min(len(self._content_rows), self.visible_rows + 2 * self.overscan)
+
+    def _max_first_row(self):
+        return max(0, len(self._content_rows) - self._window_size())
+
+    def _refresh(self):
+        self._set_layout_css(self._spacer, 'height', f'{len(self._content_rows) * self.row_height}px')
+        self._set_layout_css(self._body, 'transform', f'translateY({self._first_row * self.row_height}px)')
+
+        rows = list(self._body.children)
+        window_size = self._window_size()
+        for row in rows[window_size:]:
+            row.parent = None
+        for _ in range(len(rows), window_size):
+            row = Row(parent=self._body, row_contents=[])
+            row._css_properties['height'] = f'{self.row_height}px'
+
+        for row, row_contents in zip(
+            self._body.children, self._content_rows[self._first_row:self._first_row + window_size]
+        ):
+            self._fill_row(row, row_contents)
+
+    @staticmethod
+    def _fill_row(row, row_contents):
+        cells = list(row.children)
+        for cell in cells[len(row_contents):]:
+            cell.parent = None
+        for _ in range(len(cells), len(row_contents)):
+            Cell(parent=row, padding=VirtualTable._cell_padding)
+        for cell, value in zip(row.children, row_contents):
+            cell.text = str(value)
+
+    @staticmethod
+    def _set_layout_css(view, css_name, css_value):
+        if view._css_properties.get(css_name) != css_value:
+            view._css_properties[css_name] = css_value
+            view._mark_dirty()